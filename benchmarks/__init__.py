@@ -0,0 +1,9 @@
+"""Benchmarks driving gridfs_fuse.operations.Operations without a kernel mount.
+
+Run them from the repository root, e.g.
+    python -m benchmarks.suite --mongodb-uri mongodb://127.0.0.1:27017 --output after.json
+    python -m benchmarks.compare before.json after.json
+
+Every benchmark works on a throwaway database which is dropped beforehand.
+'--mongomock' runs them in-memory (pip install mongomock).
+"""
@@ -0,0 +1,82 @@
+"""Sequential write and read throughput for different gridfs chunk sizes."""
+import os
+import stat
+import time
+
+import llfuse
+
+from benchmarks.common import CTX
+from benchmarks.common import parse_args
+from benchmarks.common import fresh_operations
+from gridfs_fuse.main import size_type
+
+MB = 1024 * 1024
+
+
+def configure(parser):
+    parser.add_argument(
+        '--chunk-sizes',
+        type=size_type,
+        nargs='+',
+        default=[255 * 1024, 1 * MB, 4 * MB, 15 * MB])
+
+    parser.add_argument(
+        '--file-size',
+        type=size_type,
+        default=1024 * MB)
+
+    parser.add_argument(
+        '--block-size',
+        type=size_type,
+        default=128 * 1024,
+        help="Size of a single write/read call, like the kernel does")
+
+
+def write_file(ops, name, file_size, block):
+    mode = stat.S_IFREG | 0o644
+    fd, attr = ops.create(llfuse.ROOT_INODE, name, mode, 0, CTX)
+
+    offset = 0
+    while offset < file_size:
+        offset += ops.write(fd, offset, block)
+
+    ops.release(fd)
+    return attr.st_ino
+
+
+def read_file(ops, inode, file_size, block_size):
+    fd = ops.open(inode, os.O_RDONLY, CTX)
+
+    offset = 0
+    while offset < file_size:
+        offset += len(ops.read(fd, offset, block_size))
+
+    ops.release(fd)
+
+
+def main():
+    options = parse_args(configure)
+    block = os.urandom(options.block_size)
+
+    print("%12s %14s %14s" % ("chunk size", "write [MB/s]", "read [MB/s]"))
+
+    for chunk_size in options.chunk_sizes:
+        # No chunk cache hits from earlier rounds
+        ops = fresh_operations(options, chunk_size=chunk_size)
+
+        try:
+            start = time.perf_counter()
+            inode = write_file(ops, b'bench', options.file_size, block)
+            write = options.file_size / (time.perf_counter() - start) / MB
+
+            start = time.perf_counter()
+            read_file(ops, inode, options.file_size, options.block_size)
+            read = options.file_size / (time.perf_counter() - start) / MB
+        finally:
+            ops.destroy()
+
+        print("%12d %14.1f %14.1f" % (chunk_size, write, read))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import os
+import stat
+import argparse
+import collections
+
+from gridfs_fuse.operations import Operations
+from gridfs_fuse.operations import create_mongo_client
+from gridfs_fuse.operations import _ensure_root_inode
+from gridfs_fuse.operations import _ensure_next_inode_document
+from gridfs_fuse.operations import _ensure_indexes
+
+
+# Stand-in for llfuse.RequestContext, Operations only reads uid/gid.
+Context = collections.namedtuple('Context', ['uid', 'gid', 'pid', 'umask'])
+CTX = Context(os.getuid(), os.getgid(), os.getpid(), 0o022)
+
+
+def configure_argparse(parser):
+    parser.add_argument(
+        '--mongodb-uri',
+        dest='mongodb_uri',
+        default="mongodb://127.0.0.1:27017",
+        help="Connection string of a throwaway mongod")
+
+    parser.add_argument(
+        '--database',
+        dest='database',
+        default='gridfs_fuse_benchmark',
+        help="Database to use, it is DROPPED before every run")
+
+    parser.add_argument(
+        '--mongomock',
+        action='store_true',
+        help="Run against the in-memory mongomock instead of a mongod. "
+             "Only useful to compare code paths, not round trip costs")
+
+    return parser
+
+
+def parse_args(configure):
+    parser = argparse.ArgumentParser()
+    configure_argparse(parser)
+    configure(parser)
+    return parser.parse_args()
+
+
+def fresh_database(options):
+    if options.mongomock:
+        import mongomock
+        import mongomock.gridfs
+
+        # gridfs.GridFS insists on a real pymongo database otherwise
+        mongomock.gridfs.enable_gridfs_integration()
+        client = mongomock.MongoClient()
+    else:
+        client = create_mongo_client(options.mongodb_uri)
+
+    client.drop_database(options.database)
+    return client[options.database]
+
+
+def fresh_operations(options, **kwargs):
+    ops = Operations(fresh_database(options), **kwargs)
+    _ensure_root_inode(ops)
+    _ensure_next_inode_document(ops)
+    _ensure_indexes(ops)
+    return ops
+
+
+def fill(ops, folder_inode, start, count, batch=10000):
+    """Add 'count' empty files to a folder with plain inserts (fast)."""
+    mode = stat.S_IFREG | 0o644
+    done = 0
+    while done < count:
+        n = min(batch, count - done)
+        first = ops.meta.find_one_and_update(
+            {"_id": "next_inode"},
+            {"$inc": {"value": n}})['value']
+
+        ops.meta.insert_many([
+            {
+                '_id': inode,
+                'filename': b'fill-%d' % (start + done + i),
+                'parent_inode': folder_inode,
+                'mode': mode,
+                'uid': CTX.uid,
+                'gid': CTX.gid,
+                'atime_ns': 0,
+                'mtime_ns': 0,
+                'ctime_ns': 0,
+                'length': 0,
+                'chunk_size': 0,
+            }
+            for i, inode in enumerate(range(first, first + n))
+        ], ordered=False)
+        done += n
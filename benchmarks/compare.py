@@ -0,0 +1,35 @@
+"""Compare two result files of benchmarks.suite."""
+import sys
+import json
+
+
+def key(result):
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+
+def rate(result):
+    return result.get('mb_per_second') or result['ops_per_second']
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m benchmarks.compare before.json after.json")
+
+    with open(sys.argv[1]) as f:
+        before = {key(r): r for r in json.load(f)['results']}
+    with open(sys.argv[2]) as f:
+        after = json.load(f)['results']
+
+    print("%-16s %-40s %12s %12s %8s" % ("name", "params", "before", "after", "ratio"))
+    for result in after:
+        old = before.get(key(result))
+        if old is None:
+            continue
+
+        ratio = rate(result) / rate(old) if rate(old) else float('nan')
+        print("%-16s %-40s %12.1f %12.1f %7.2fx" % (
+            result['name'], key(result)[1][:40], rate(old), rate(result), ratio))
+
+
+if __name__ == '__main__':
+    main()
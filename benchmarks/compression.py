@@ -0,0 +1,142 @@
+"""Ratio and throughput of chunk compression vs. uncompressed chunks.
+
+First the codecs alone (CPU only), then sequential write and read of a
+file through Operations for every codec. Without '--sample' the data is
+generated text, roughly as compressible as logs or CSV files.
+"""
+import stat
+import time
+import random
+
+import llfuse
+
+from benchmarks.common import CTX
+from benchmarks.common import parse_args
+from benchmarks.common import fresh_operations
+from benchmarks.chunk_size import read_file
+from gridfs_fuse import compression
+from gridfs_fuse.main import size_type
+from gridfs_fuse.operations import DEFAULT_CHUNK_SIZE
+
+MB = 1024 * 1024
+
+
+def configure(parser):
+    parser.add_argument(
+        '--sample',
+        help="File whose content is written, repeated up to '--file-size'")
+
+    parser.add_argument(
+        '--file-size',
+        type=size_type,
+        default=256 * MB)
+
+    parser.add_argument(
+        '--block-size',
+        type=size_type,
+        default=128 * 1024,
+        help="Size of a single write/read call, like the kernel does")
+
+
+def generate_text(size):
+    rnd = random.Random(42)
+    words = [
+        bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(2, 10)))
+        for _ in range(5000)
+    ]
+
+    lines = []
+    length = 0
+    while length < size:
+        line = b'%d,%s,%.3f\n' % (
+            rnd.randint(0, 10 ** 9),
+            b' '.join(rnd.choice(words) for _ in range(8)),
+            rnd.random())
+        lines.append(line)
+        length += len(line)
+    return b''.join(lines)[:size]
+
+
+def sample_data(options):
+    if options.sample is None:
+        return generate_text(4 * MB)
+
+    with open(options.sample, 'rb') as f:
+        return f.read(4 * MB)
+
+
+def repeat_to(data, size):
+    return (data * (size // len(data) + 1))[:size]
+
+
+def write_blocks(ops, name, blocks):
+    mode = stat.S_IFREG | 0o644
+    fd, attr = ops.create(llfuse.ROOT_INODE, name, mode, 0, CTX)
+
+    offset = 0
+    for block in blocks:
+        offset += ops.write(fd, offset, block)
+
+    ops.release(fd)
+    return attr.st_ino
+
+
+def codec_only(codec, data):
+    chunks = [
+        data[offset:offset + DEFAULT_CHUNK_SIZE]
+        for offset in range(0, len(data), DEFAULT_CHUNK_SIZE)
+    ]
+
+    start = time.perf_counter()
+    compressed = [compression.compress(codec, chunk) for chunk in chunks]
+    compress = len(data) / (time.perf_counter() - start) / MB
+
+    start = time.perf_counter()
+    for chunk in compressed:
+        compression.decompress(codec, chunk)
+    decompress = len(data) / (time.perf_counter() - start) / MB
+
+    ratio = len(data) / float(sum(len(chunk) for chunk in compressed))
+    return ratio, compress, decompress
+
+
+def main():
+    options = parse_args(configure)
+    data = sample_data(options)
+    codecs = sorted(compression.CODECS)
+
+    print("%12s %10s %16s %18s" % (
+        "codec", "ratio", "compress [MB/s]", "decompress [MB/s]"))
+    for codec in codecs:
+        ratio, compress, decompress = codec_only(codec, data)
+        print("%12s %10.2f %16.1f %18.1f" % (codec, ratio, compress, decompress))
+
+    print()
+    print("%12s %14s %14s" % ("codec", "write [MB/s]", "read [MB/s]"))
+
+    content = repeat_to(data, options.file_size)
+    blocks = [
+        content[offset:offset + options.block_size]
+        for offset in range(0, options.file_size, options.block_size)
+    ]
+
+    for codec in [None] + codecs:
+        # No chunk cache hits from earlier rounds
+        ops = fresh_operations(options, compression=codec)
+
+        try:
+            start = time.perf_counter()
+            inode = write_blocks(ops, b'bench', blocks)
+            write = options.file_size / (time.perf_counter() - start) / MB
+
+            start = time.perf_counter()
+            read_file(ops, inode, options.file_size, options.block_size)
+            read = options.file_size / (time.perf_counter() - start) / MB
+        finally:
+            ops.destroy()
+
+        print("%12s %14.1f %14.1f" % (codec or compression.NONE, write, read))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Create/unlink cost depending on the size of the directory.
+
+The directory is filled with plain metadata documents (fast),
+then files are created and unlinked through Operations.
+"""
+import stat
+import time
+
+import llfuse
+
+from benchmarks.common import CTX
+from benchmarks.common import parse_args
+from benchmarks.common import fresh_operations
+from benchmarks.common import fill
+
+
+def configure(parser):
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[1000, 10000, 100000, 1000000, 10000000])
+
+    parser.add_argument(
+        '--ops',
+        type=int,
+        default=1000,
+        help="Number of create/unlink calls per directory size")
+
+
+def run(ops, count):
+    mode = stat.S_IFREG | 0o644
+    names = [b'bench-%d' % i for i in range(count)]
+
+    start = time.perf_counter()
+    for name in names:
+        fd, _ = ops.create(llfuse.ROOT_INODE, name, mode, 0, CTX)
+        ops.release(fd)
+    create = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name in names:
+        ops.unlink(llfuse.ROOT_INODE, name, CTX)
+    unlink = time.perf_counter() - start
+
+    return create / count, unlink / count
+
+
+def main():
+    options = parse_args(configure)
+    ops = fresh_operations(options)
+
+    print("%12s %14s %14s" % ("entries", "create [us]", "unlink [us]"))
+
+    filled = 0
+    for size in sorted(options.sizes):
+        fill(ops, llfuse.ROOT_INODE, filled, size - filled)
+        filled = size
+
+        create, unlink = run(ops, options.ops)
+        print("%12d %14.1f %14.1f" % (size, create * 1e6, unlink * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Memory of cached entries, __slots__ Entry vs. the former __dict__ one.
+
+Decodes synthetic inode documents into the entry cache of Operations,
+no round trips involved. The former layout is emulated by a plain class
+holding the same fields in its __dict__.
+"""
+import gc
+import stat
+import tracemalloc
+
+import llfuse
+
+from benchmarks.common import CTX
+from benchmarks.common import parse_args
+from benchmarks.common import fresh_operations
+from gridfs_fuse.cache import LRUCache
+
+
+class DictEntry(object):
+    pass
+
+
+def configure(parser):
+    parser.add_argument(
+        '--entries',
+        type=int,
+        default=1000000)
+
+
+def make_doc(inode):
+    return {
+        '_id': inode,
+        'filename': b'file-%d' % inode,
+        'parent_inode': llfuse.ROOT_INODE,
+        'mode': stat.S_IFREG | 0o644,
+        'uid': CTX.uid,
+        'gid': CTX.gid,
+        'atime_ns': 1500000000000000000 + inode,
+        'mtime_ns': 1500000000000000000 + inode,
+        'ctime_ns': 1500000000000000000 + inode,
+        'length': inode * 10,
+        'chunk_size': 255 * 1024,
+        'md5': None,
+    }
+
+
+def dict_entry(doc):
+    entry = object.__new__(DictEntry)
+    entry.__dict__.update(doc)
+    return entry
+
+
+def measure(cache, decode, count):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for inode in range(llfuse.ROOT_INODE + 1, llfuse.ROOT_INODE + 1 + count):
+        cache.put(inode, decode(make_doc(inode)))
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    cache.clear()
+    return used
+
+
+def main():
+    options = parse_args(configure)
+    count = options.entries
+    ops = fresh_operations(options, metadata_cache_size=count)
+
+    print("%12s %14s %14s" % ("layout", "total [MB]", "entry [bytes]"))
+    for name, cache, decode in (
+            ('__dict__', LRUCache(count), dict_entry),
+            ('__slots__', ops.entry_cache, ops._doc_to_entry)):
+        used = measure(cache, decode, count)
+        print("%12s %14.1f %14.1f" % (name, used / 1024.0 ** 2, used / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""Benchmark suite for the metadata and data paths of Operations.
+
+Emits one JSON document, so results of two commits can be compared with
+    python -m benchmarks.compare before.json after.json
+"""
+import os
+import sys
+import json
+import stat
+import time
+import random
+import platform
+import subprocess
+
+import llfuse
+
+from benchmarks.common import CTX
+from benchmarks.common import fill
+from benchmarks.common import parse_args
+from benchmarks.common import fresh_operations
+from gridfs_fuse.main import size_type
+
+MB = 1024 * 1024
+
+FILE_MODE = stat.S_IFREG | 0o644
+DIR_MODE = stat.S_IFDIR | 0o755
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def configure(parser):
+    parser.add_argument(
+        '--count',
+        type=int,
+        default=1000,
+        help="Number of create/mkdir/unlink/lookup calls")
+
+    parser.add_argument(
+        '--readdir-sizes',
+        dest='readdir_sizes',
+        type=int,
+        nargs='+',
+        default=[10, 1000, 100000])
+
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=20,
+        help="Length of the folder chain resolved by the lookup benchmark")
+
+    parser.add_argument(
+        '--file-size',
+        dest='file_size',
+        type=size_type,
+        default=256 * MB)
+
+    parser.add_argument(
+        '--block-size',
+        dest='block_size',
+        type=size_type,
+        default=128 * 1024,
+        help="Size of a single write/read call, like the kernel does")
+
+    parser.add_argument(
+        '--random-reads',
+        dest='random_reads',
+        type=int,
+        default=1000)
+
+    parser.add_argument(
+        '--only',
+        nargs='+',
+        default=None,
+        help="Run only these benchmarks")
+
+    parser.add_argument(
+        '--output',
+        default=None,
+        help="Write the JSON results to this file instead of stdout")
+
+
+def result(name, count, seconds, nbytes=None, **params):
+    doc = {
+        'name': name,
+        'params': params,
+        'count': count,
+        'seconds': seconds,
+        'ops_per_second': count / seconds if seconds else None,
+    }
+    if nbytes is not None:
+        doc['mb_per_second'] = nbytes / seconds / MB if seconds else None
+    return doc
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+@benchmark
+def metadata(options):
+    ops = fresh_operations(options)
+    names = [b'file-%d' % i for i in range(options.count)]
+    folders = [b'folder-%d' % i for i in range(options.count)]
+
+    def create():
+        for name in names:
+            fd, _ = ops.create(llfuse.ROOT_INODE, name, FILE_MODE, 0, CTX)
+            ops.release(fd)
+
+    def mkdir():
+        for name in folders:
+            ops.mkdir(llfuse.ROOT_INODE, name, DIR_MODE, CTX)
+
+    def unlink():
+        for name in names:
+            ops.unlink(llfuse.ROOT_INODE, name, CTX)
+
+    def rmdir():
+        for name in folders:
+            ops.rmdir(llfuse.ROOT_INODE, name, CTX)
+
+    try:
+        return [
+            result(name, options.count, timed(func))
+            for name, func in [
+                ('create', create),
+                ('mkdir', mkdir),
+                ('unlink', unlink),
+                ('rmdir', rmdir)
+            ]
+        ]
+    finally:
+        ops.destroy()
+
+
+@benchmark
+def readdir(options):
+    results = []
+    for size in options.readdir_sizes:
+        ops = fresh_operations(options)
+        try:
+            folder = ops.mkdir(llfuse.ROOT_INODE, b'folder', DIR_MODE, CTX)
+            fill(ops, folder.st_ino, 0, size)
+
+            def listing():
+                entries = sum(1 for _ in ops.readdir(folder.st_ino, 0))
+                assert entries == size, entries
+
+            results.append(result('readdir', size, timed(listing), entries=size))
+        finally:
+            ops.destroy()
+
+    return results
+
+
+@benchmark
+def lookup(options):
+    results = []
+
+    # Cold: every component is a round trip. Warm: served by the caches.
+    for cache_size in (0, options.count * options.depth):
+        ops = fresh_operations(options, metadata_cache_size=cache_size)
+        try:
+            inode = llfuse.ROOT_INODE
+            for level in range(options.depth):
+                inode = ops.mkdir(inode, b'level-%d' % level, DIR_MODE, CTX).st_ino
+
+            def resolve():
+                for _ in range(options.count):
+                    inode = llfuse.ROOT_INODE
+                    for level in range(options.depth):
+                        inode = ops.lookup(inode, b'level-%d' % level, CTX).st_ino
+
+            lookups = options.count * options.depth
+            results.append(result(
+                'lookup', lookups, timed(resolve),
+                depth=options.depth,
+                cache='warm' if cache_size else 'cold'))
+        finally:
+            ops.destroy()
+
+    return results
+
+
+@benchmark
+def data(options):
+    ops = fresh_operations(options)
+    block = os.urandom(options.block_size)
+    size = options.file_size
+
+    state = {}
+
+    def write():
+        fd, attr = ops.create(llfuse.ROOT_INODE, b'stream', FILE_MODE, 0, CTX)
+        offset = 0
+        while offset < size:
+            offset += ops.write(fd, offset, block)
+        ops.release(fd)
+        state['inode'] = attr.st_ino
+
+    def read_sequential():
+        fd = ops.open(state['inode'], os.O_RDONLY, CTX)
+        offset = 0
+        while offset < size:
+            offset += len(ops.read(fd, offset, options.block_size))
+        ops.release(fd)
+
+    def read_random():
+        fd = ops.open(state['inode'], os.O_RDONLY, CTX)
+        for offset in offsets:
+            ops.read(fd, offset, 4096)
+        ops.release(fd)
+
+    rnd = random.Random(42)
+    offsets = [rnd.randrange(0, size - 4096) for _ in range(options.random_reads)]
+
+    try:
+        results = [
+            result('write_stream', size // options.block_size, timed(write), size,
+                   block_size=options.block_size, file_size=size),
+        ]
+
+        ops.chunk_cache.clear()
+        results.append(result(
+            'read_sequential', size // options.block_size, timed(read_sequential),
+            size, block_size=options.block_size, file_size=size))
+
+        ops.chunk_cache.clear()
+        results.append(result(
+            'read_random', options.random_reads, timed(read_random),
+            options.random_reads * 4096, read_size=4096, file_size=size))
+
+        return results
+    finally:
+        ops.destroy()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    options = parse_args(configure)
+
+    results = []
+    for func in BENCHMARKS:
+        if options.only and func.__name__ not in options.only:
+            continue
+        print("running %s" % func.__name__, file=sys.stderr)
+        results.extend(func(options))
+
+    doc = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'backend': 'mongomock' if options.mongomock else 'mongod',
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(doc, f, indent=2)
+    else:
+        json.dump(doc, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
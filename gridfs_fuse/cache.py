@@ -0,0 +1,205 @@
+"""In-process caches used by the filesystem operations."""
+import collections
+import logging
+import threading
+import time
+
+import pymongo
+
+
+class LRUCache(object):
+    """Bounded, thread safe LRU mapping with an optional time to live.
+
+    ``token``/``put`` protect against a classic race: a value read from
+    mongodb before an invalidation arrived must not be stored after it.
+    Take a token before the read and hand it to ``put``.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def token(self):
+        return self._generation
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, token=None, ttl=None):
+        if self.maxsize <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+
+        with self._lock:
+            if token is not None and token != self._generation:
+                return
+
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ChangeStreamWatcher(threading.Thread):
+    """Tail the change stream of a collection in a background thread.
+
+    Every change event is passed to ``on_change``.
+    ``on_reset(watching)`` is called whenever events might have been missed
+    (stream (re)opened or broken), so cached state can be dropped.
+    If the deployment has no change streams (standalone server)
+    the thread gives up and reports ``watching=False`` for good.
+    ``pipeline`` can trim the events to the fields ``on_change`` needs.
+    """
+
+    def __init__(self, collection, on_change, on_reset, pipeline=None):
+        super(ChangeStreamWatcher, self).__init__(
+            name="gridfs_fuse-change-stream",
+            daemon=True)
+
+        self.logger = logging.getLogger("gridfs_fuse")
+
+        self.collection = collection
+        self.on_change = on_change
+        self.on_reset = on_reset
+        self.pipeline = pipeline
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._watch()
+            except pymongo.errors.OperationFailure as e:
+                self.logger.warning(
+                    "Change streams are not available (%s). "
+                    "Metadata cache relies on its TTL only.", e)
+                self.on_reset(False)
+                return
+            except pymongo.errors.PyMongoError:
+                self.logger.exception("Change stream broke, reopening it")
+                self.on_reset(False)
+                self._stopped.wait(1)
+
+    def _watch(self):
+        stream = self.collection.watch(
+            self.pipeline,
+            full_document='updateLookup',
+            max_await_time_ms=1000)
+
+        with stream:
+            # Everything cached before this point might be outdated.
+            self.on_reset(True)
+
+            while stream.alive and not self._stopped.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    self.on_change(change)
+
+
+class ChunkCache(object):
+    """Thread safe LRU of gridfs chunks bounded by their total size.
+
+    Keys are (files_id, n). Files are write once and inodes are never
+    reused, so cached chunks never get outdated.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._data[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'chunks': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,76 @@
+"""Optional client-side compression of chunk data.
+
+Every chunk is compressed on its own, so any chunk can still be read
+alone. zlib is always available, zstd and lz4 only if installed:
+    pip install gridfs_fuse[zstd]
+    pip install gridfs_fuse[lz4]
+The codec of a file is recorded within its inode ('compression').
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Folder/mount setting: store new files uncompressed
+NONE = 'none'
+
+KNOWN_CODECS = (NONE, 'zlib', 'zstd', 'lz4')
+
+# Fast levels, the aim is less data on the wire, not the best ratio
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+
+
+class CodecUnavailable(Exception):
+    @classmethod
+    def make(cls, name):
+        return cls("Compression '%s' is not available" % name)
+
+
+def _zstd_compress(data):
+    # Compressor objects must not be shared between threads
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# name: (compress, decompress)
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, ZLIB_LEVEL), zlib.decompress),
+}
+
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_compress, _zstd_decompress)
+
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+def check(name):
+    if name != NONE and name not in CODECS:
+        raise CodecUnavailable.make(name)
+
+
+def compress(name, data):
+    return _codec(name)[0](data)
+
+
+def decompress(name, data):
+    return _codec(name)[1](data)
+
+
+def _codec(name):
+    codec = CODECS.get(name)
+    if codec is None:
+        raise CodecUnavailable.make(name)
+    return codec
@@ -0,0 +1,148 @@
+"""Content addressed storage of chunk data.
+
+In dedup mode a chunk document carries the sha256 'hash' of its data
+instead of the data. The data is kept once per hash within the 'blocks'
+collection together with the number of chunks referencing it. Data of a
+block which already exists is not sent at all, referencing it costs a
+small update instead.
+
+Readers and the reaper handle both kinds of chunks, regardless of the
+mode of the mount.
+"""
+import hashlib
+import collections
+
+import pymongo
+from bson import Binary
+
+from .group_commit import DUPLICATE_KEY
+
+
+class BlockStore(object):
+    def __init__(self, blocks_collection):
+        self.blocks = blocks_collection
+
+        # Chunk bytes this process did not send since the block existed
+        self.saved_bytes = 0
+
+    def store(self, chunk_docs):
+        """Move 'data' of the chunk documents into blocks, keep a 'hash'.
+
+        One bulk write per batch: known blocks get a reference, the others
+        are created together with their data. A chunk never references a
+        block without data, blocks are complete before the chunks are inserted.
+        """
+        hashes = [Binary(hashlib.sha256(doc['data']).digest()) for doc in chunk_docs]
+
+        # hash: (number of chunks, data)
+        wanted = collections.OrderedDict()
+        for doc, hash_ in zip(chunk_docs, hashes):
+            count, _ = wanted.get(hash_, (0, None))
+            wanted[hash_] = (count + 1, doc['data'])
+
+        query = {'_id': {'$in': list(wanted)}, 'data': {'$exists': True}}
+        known = set(doc['_id'] for doc in self.blocks.find(query, {'_id': True}))
+
+        # A known block deleted by the reaper meanwhile is created again
+        # without data (upserted) or, if a block without data is left, the
+        # upsert fails on its _id (duplicate). Both get their data below.
+        order = list(wanted)
+        requests = []
+        for hash_ in order:
+            count, data = wanted[hash_]
+            if hash_ in known:
+                requests.append(pymongo.UpdateOne(
+                    {'_id': hash_, 'data': {'$exists': True}},
+                    {'$inc': {'refs': count}},
+                    upsert=True))
+            else:
+                requests.append(_create(hash_, count, data))
+
+        upserted, duplicates = self._bulk_write(requests)
+
+        repairs = []
+        for index, hash_ in enumerate(order):
+            count, data = wanted[hash_]
+            if index in duplicates:
+                repairs.append(_create(hash_, count, data))
+            elif hash_ in known and index in upserted:
+                repairs.append(pymongo.UpdateOne(
+                    {'_id': hash_},
+                    {'$set': {'data': data, 'size': len(data)}}))
+            elif hash_ in known:
+                self.saved_bytes += count * len(data)
+                continue
+
+            # Only the first chunk of a batch sends the data
+            self.saved_bytes += (count - 1) * len(data)
+
+        if repairs:
+            self.blocks.bulk_write(repairs, ordered=False)
+
+        for doc, hash_ in zip(chunk_docs, hashes):
+            del doc['data']
+            doc['hash'] = hash_
+
+    def _bulk_write(self, requests):
+        """Returns the indexes of the upserts and of duplicate key failures."""
+        try:
+            result = self.blocks.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != DUPLICATE_KEY for error in errors):
+                raise
+
+            upserted = set(doc['index'] for doc in e.details.get('upserted', []))
+            return upserted, set(error['index'] for error in errors)
+
+        return set(result.upserted_ids), set()
+
+    def fetch(self, hashes):
+        """Return {hash: data} of the blocks, missing ones are left out."""
+        query = {'_id': {'$in': list(set(hashes))}}
+        projection = {'data': True}
+
+        blocks = {}
+        for doc in self.blocks.find(query, projection):
+            # Block of an older version, created before its data was set
+            if 'data' in doc:
+                blocks[doc['_id']] = bytes(doc['data'])
+        return blocks
+
+    def release(self, hashes):
+        """Drop one reference per hash, delete unreferenced blocks."""
+        counts = collections.Counter(hashes)
+        self.blocks.bulk_write([
+            pymongo.UpdateOne({'_id': hash_}, {'$inc': {'refs': -count}})
+            for hash_, count in counts.items()
+        ], ordered=False)
+
+        # A writer referencing such a block meanwhile keeps it alive
+        # (refs > 0) or creates it again (upsert).
+        self.blocks.delete_many({'_id': {'$in': list(counts)}, 'refs': {'$lte': 0}})
+
+    def report(self):
+        pipeline = [{
+            '$group': {
+                '_id': None,
+                'blocks': {'$sum': 1},
+                'stored': {'$sum': '$size'},
+                'referenced': {'$sum': {'$multiply': ['$size', '$refs']}},
+            }
+        }]
+
+        for doc in self.blocks.aggregate(pipeline):
+            del doc['_id']
+            return doc
+        return {'blocks': 0, 'stored': 0, 'referenced': 0}
+
+
+def _create(hash_, count, data):
+    # '$set' instead of '$setOnInsert' also repairs a block without data
+    return pymongo.UpdateOne(
+        {'_id': hash_},
+        {
+            '$inc': {'refs': count},
+            '$set': {'data': data, 'size': len(data)}
+        },
+        upsert=True)
@@ -0,0 +1,44 @@
+"""Report how much chunk data got deduplicated (mounts with --dedup)."""
+import argparse
+
+from gridfs_fuse.operations import create_mongo_client
+from gridfs_fuse.dedup import BlockStore
+
+
+def configure_argparse(parser):
+    parser.add_argument(
+        '--mongodb-uri',
+        dest='mongodb_uri',
+        default="mongodb://127.0.0.1:27017",
+        help="Connection string for MongoClient. http://goo.gl/abqY9")
+
+    parser.add_argument(
+        '--database',
+        dest='database',
+        default='gridfs_fuse',
+        help="Name of the database where the filesystem goes")
+
+    return parser
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    configure_argparse(parser)
+    options = parser.parse_args()
+
+    client = create_mongo_client(options.mongodb_uri)
+    report = BlockStore(client[options.database]['blocks']).report()
+
+    referenced = report['referenced']
+    stored = report['stored']
+
+    # Every reference beyond the first one skipped the upload of its data
+    print("blocks:            %d" % report['blocks'])
+    print("referenced bytes:  %d" % referenced)
+    print("stored bytes:      %d" % stored)
+    print("dedup ratio:       %.2f" % (referenced / stored if stored else 1.0))
+    print("bytes not written: %d" % (referenced - stored))
+
+
+if __name__ == '__main__':
+    main()
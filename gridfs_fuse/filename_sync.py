@@ -0,0 +1,106 @@
+"""Keeps 'fs.files' filenames in sync after a folder got moved.
+
+Gridfs filenames carry the full path of a file (for mongofiles, ngx_gridfs
+and friends). Moving a folder changes the path of every descendant.
+Rewriting them can take long for big trees, so it is done in the
+background in bulk batches. Jobs run one after the other, so the last
+move of a folder always wins. Jobs are not persisted, an unmount during
+a rewrite leaves outdated filenames behind.
+"""
+import os
+import stat
+import time
+import queue
+import logging
+import threading
+import collections
+
+import pymongo
+
+
+class FilenameRewriter(object):
+    def __init__(self, meta, gridfs_files, batch_size=1000):
+        self.logger = logging.getLogger("gridfs_fuse")
+
+        self.meta = meta
+        self.gridfs_files = gridfs_files
+        self.batch_size = batch_size
+
+        # Progress of the running job, None if idle
+        self.current = None
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="gridfs_fuse-filename-rewrite",
+            daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._queue.put(None)
+
+    def pending(self):
+        return self._queue.qsize() + (self.current is not None)
+
+    def submit(self, folder_inode, folder_path):
+        self._queue.put((folder_inode, folder_path))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            folder_inode, folder_path = job
+            self.current = {
+                'folder_inode': folder_inode,
+                'folder_path': folder_path,
+                'folders': 0,
+                'files': 0,
+                'started': time.monotonic()
+            }
+
+            try:
+                self._rewrite(folder_inode, folder_path)
+            except pymongo.errors.PyMongoError:
+                self.logger.exception(
+                    "Filename rewrite below %s failed: %s",
+                    folder_path, self.current)
+            else:
+                self.logger.info(
+                    "Rewrote gridfs filenames below %s: %s",
+                    folder_path, self.current)
+            finally:
+                self.current = None
+
+    def _rewrite(self, folder_inode, folder_path):
+        # Breadth first, every folder is one (parent_inode, _id) index scan.
+        folders = collections.deque([(folder_inode, folder_path)])
+        projection = {'filename': True, 'mode': True}
+
+        while folders:
+            inode, path = folders.popleft()
+            query = {'parent_inode': inode, '_id': {'$ne': inode}}
+
+            batch = []
+            for doc in self.meta.find(query, projection):
+                child_path = os.path.join(path, doc['filename'])
+
+                if stat.S_ISDIR(doc['mode']):
+                    folders.append((doc['_id'], child_path))
+                    continue
+
+                update = {'$set': {'filename': child_path}}
+                batch.append(pymongo.UpdateOne({'_id': doc['_id']}, update))
+
+                if len(batch) >= self.batch_size:
+                    self._flush(batch)
+                    batch = []
+
+            self._flush(batch)
+            self.current['folders'] += 1
+
+    def _flush(self, batch):
+        if batch:
+            self.gridfs_files.bulk_write(batch, ordered=False)
+            self.current['files'] += len(batch)
@@ -0,0 +1,101 @@
+"""Group commit of metadata writes from concurrent requests.
+
+With several workers, creates arrive in bursts (tar x, unpacking of
+artifacts). The first writer of a group waits 'window' seconds for others
+to join, then sends the whole group as one bulk_write => one round trip
+per group instead of one per write. Every caller waits for its group
+and gets the outcome of its own write, e.g. DuplicateKeyError.
+"""
+import threading
+
+import pymongo
+
+
+DEFAULT_WINDOW = 0
+MAX_BATCH = 1000
+
+DUPLICATE_KEY = 11000
+
+
+class _Pending(object):
+    __slots__ = ('request', 'error', 'done')
+
+    def __init__(self, request):
+        self.request = request
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    def __init__(self, collection, window, max_batch=MAX_BATCH):
+        self.collection = collection
+        self.window = window
+        self.max_batch = max_batch
+
+        # Number of bulk writes and of the writes within them
+        self.batches = 0
+        self.requests = 0
+
+        self._queue = []
+        self._cond = threading.Condition()
+
+    def submit(self, request):
+        """Execute a pymongo write model (InsertOne, UpdateOne, ...)."""
+        pending = _Pending(request)
+
+        with self._cond:
+            self._queue.append(pending)
+            leader = len(self._queue) == 1
+            if len(self._queue) >= self.max_batch:
+                self._cond.notify_all()
+
+            if leader:
+                self._cond.wait_for(
+                    lambda: len(self._queue) >= self.max_batch,
+                    self.window)
+                batch, self._queue = self._queue, []
+
+        if leader:
+            self._flush(batch)
+        else:
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+    def _flush(self, batch):
+        self.batches += 1
+        self.requests += len(batch)
+
+        # Writes of a group are independent (different requests),
+        # unordered => one failing write does not hold back the others.
+        try:
+            self.collection.bulk_write(
+                [pending.request for pending in batch],
+                ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                batch[error['index']].error = _write_error(error)
+
+            for error in e.details.get('writeConcernErrors', []):
+                for pending in batch:
+                    if pending.error is None:
+                        pending.error = pymongo.errors.WriteConcernError(
+                            error.get('errmsg'), error.get('code'), error)
+        except Exception as e:
+            # Not only mongodb errors (e.g. bson.errors.InvalidDocument),
+            # followers must not report success for writes never done.
+            for pending in batch:
+                if pending.error is None:
+                    pending.error = e
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+
+def _write_error(error):
+    if error.get('code') == DUPLICATE_KEY:
+        error_class = pymongo.errors.DuplicateKeyError
+    else:
+        error_class = pymongo.errors.WriteError
+    return error_class(error.get('errmsg'), error.get('code'), error)
@@ -4,7 +4,86 @@ import llfuse
 
 from gridfs_fuse.operations import operations_factory
 from gridfs_fuse.operations import create_mongo_client
+from gridfs_fuse.operations import DEFAULT_METADATA_CACHE_SIZE
+from gridfs_fuse.operations import DEFAULT_METADATA_CACHE_TTL
+from gridfs_fuse.operations import DEFAULT_NEGATIVE_LOOKUP_TTL
+from gridfs_fuse.operations import DEFAULT_CHUNK_CACHE_SIZE
+from gridfs_fuse.operations import DEFAULT_READ_AHEAD
+from gridfs_fuse.operations import DEFAULT_WRITE_BUFFER_SIZE
+from gridfs_fuse.operations import DEFAULT_CHUNK_SIZE
+from gridfs_fuse.operations import MAX_CHUNK_SIZE
+from gridfs_fuse.operations import DEFAULT_INLINE_THRESHOLD
+from gridfs_fuse.operations import MAX_INLINE_THRESHOLD
+from gridfs_fuse.operations import DEFAULT_ENTRY_TIMEOUT
+from gridfs_fuse.operations import DEFAULT_ATTR_TIMEOUT
+from gridfs_fuse.operations import DEFAULT_NEGATIVE_TIMEOUT
+from gridfs_fuse.operations import DEFAULT_INODE_BLOCK_SIZE
+from gridfs_fuse.operations import DEFAULT_GROUP_COMMIT_WINDOW
+from gridfs_fuse.operations import DEFAULT_REAPER_BATCH_SIZE
+from gridfs_fuse.operations import DEFAULT_REAPER_RATE
+from gridfs_fuse.operations import DEFAULT_STATFS_INTERVAL
 from gridfs_fuse.migrations import perform_startup_migrations
+from gridfs_fuse import compression
+from gridfs_fuse.metrics import MetricsServer
+from gridfs_fuse.tracing import DEFAULT_BUFFER_SIZE as DEFAULT_TRACE_BUFFER_SIZE
+
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def size_type(value):
+    """Parse sizes like '4096', '64K', '256M' or '1G' into bytes."""
+    value = value.strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in SIZE_UNITS:
+            return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: %r" % value)
+
+
+def positive_int_type(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number: %r" % value)
+
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %s" % number)
+    return number
+
+
+def chunk_size_type(value):
+    chunk_size = size_type(value)
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise argparse.ArgumentTypeError(
+            "chunk size must be within 1 and %s bytes" % MAX_CHUNK_SIZE)
+    return chunk_size
+
+
+def inline_threshold_type(value):
+    threshold = size_type(value)
+    if not 0 <= threshold <= MAX_INLINE_THRESHOLD:
+        raise argparse.ArgumentTypeError(
+            "inline threshold must be within 0 and %s bytes" %
+            MAX_INLINE_THRESHOLD)
+    return threshold
+
+
+def compression_type(value):
+    if value not in compression.KNOWN_CODECS:
+        raise argparse.ArgumentTypeError(
+            "unknown compression %r, choose from %s" %
+            (value, ', '.join(compression.KNOWN_CODECS)))
+
+    try:
+        compression.check(value)
+    except compression.CodecUnavailable as e:
+        raise argparse.ArgumentTypeError(
+            "%s, install gridfs_fuse[%s]" % (e, value))
+
+    # The mount default 'none' is no codec at all
+    return None if value == compression.NONE else value
 
 
 def configure_argparse(parser):
@@ -34,15 +113,211 @@ def configure_argparse(parser):
         default="INFO",
         help="Set the logging level")
 
+    parser.add_argument(
+        '--workers',
+        type=positive_int_type,
+        default=1,
+        help="Number of threads handling requests concurrently")
+
+    parser.add_argument(
+        '--metadata-cache-size',
+        dest='metadata_cache_size',
+        type=int,
+        default=DEFAULT_METADATA_CACHE_SIZE,
+        help="Number of inodes kept in the in-process metadata cache. "
+             "0 disables the cache")
+
+    parser.add_argument(
+        '--metadata-cache-ttl',
+        dest='metadata_cache_ttl',
+        type=float,
+        default=DEFAULT_METADATA_CACHE_TTL,
+        help="Seconds a cached inode stays valid if the deployment "
+             "does not support change streams (e.g. standalone mongod)")
+
+    parser.add_argument(
+        '--negative-lookup-ttl',
+        dest='negative_lookup_ttl',
+        type=float,
+        default=DEFAULT_NEGATIVE_LOOKUP_TTL,
+        help="Seconds a failed lookup (ENOENT) is cached")
+
+    parser.add_argument(
+        '--chunk-cache-size',
+        dest='chunk_cache_size',
+        type=size_type,
+        default=DEFAULT_CHUNK_CACHE_SIZE,
+        help="Memory for gridfs chunks shared by all readers, e.g. 512M")
+
+    parser.add_argument(
+        '--read-ahead',
+        dest='read_ahead',
+        type=int,
+        default=DEFAULT_READ_AHEAD,
+        help="Number of chunks prefetched on sequential reads. 0 disables it")
+
+    parser.add_argument(
+        '--write-buffer-size',
+        dest='write_buffer_size',
+        type=size_type,
+        default=DEFAULT_WRITE_BUFFER_SIZE,
+        help="Memory for written chunks waiting for their upload, e.g. 128M. "
+             "Writers block if it is used up")
+
+    parser.add_argument(
+        '--chunk-size',
+        dest='chunk_size',
+        type=chunk_size_type,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Gridfs chunk size of new files, e.g. 4M (max. 15M). "
+             "Folders can override it with the xattr 'user.gridfs.chunk_size'")
+
+    parser.add_argument(
+        '--inline-threshold',
+        dest='inline_threshold',
+        type=inline_threshold_type,
+        default=DEFAULT_INLINE_THRESHOLD,
+        help="Files up to this size, e.g. 64K, are kept within their inode "
+             "document instead of gridfs. 0 (default) disables it. "
+             "Other tools (mongofiles, ...) do not see these files")
+
+    parser.add_argument(
+        '--compression',
+        type=compression_type,
+        default=None,
+        help="Compress chunks of new files on the client with one of %s. "
+             "zstd/lz4 need gridfs_fuse[zstd]/gridfs_fuse[lz4]. "
+             "Folders can override it with the xattr 'user.gridfs.compression'. "
+             "Such files are not readable by other gridfs tools" %
+             ', '.join(compression.KNOWN_CODECS))
+
+    parser.add_argument(
+        '--dedup',
+        action='store_true',
+        help="Store identical chunks of new files only once (sha256). "
+             "Such files are not readable by other gridfs tools. "
+             "See gridfs_fuse_dedup_report")
+
+    parser.add_argument(
+        '--entry-timeout',
+        dest='entry_timeout',
+        type=float,
+        default=DEFAULT_ENTRY_TIMEOUT,
+        help="Seconds the kernel caches names")
+
+    parser.add_argument(
+        '--attr-timeout',
+        dest='attr_timeout',
+        type=float,
+        default=DEFAULT_ATTR_TIMEOUT,
+        help="Seconds the kernel caches attributes of folders and closed files")
+
+    parser.add_argument(
+        '--negative-timeout',
+        dest='negative_timeout',
+        type=float,
+        default=DEFAULT_NEGATIVE_TIMEOUT,
+        help="Seconds the kernel caches failed lookups. "
+             "0 (default) does not cache them, "
+             "which is safe if several nodes mount the same database")
+
+    parser.add_argument(
+        '--inode-block-size',
+        dest='inode_block_size',
+        type=positive_int_type,
+        default=DEFAULT_INODE_BLOCK_SIZE,
+        help="Number of inodes leased at once for new files and folders")
+
+    parser.add_argument(
+        '--group-commit-window',
+        dest='group_commit_window',
+        type=float,
+        default=DEFAULT_GROUP_COMMIT_WINDOW,
+        help="Seconds a metadata write (create, mkdir, close) waits for "
+             "concurrent ones to be sent together, e.g. 0.002. "
+             "Only useful with --workers > 1. 0 (default) disables it")
+
+    parser.add_argument(
+        '--reaper-batch-size',
+        dest='reaper_batch_size',
+        type=int,
+        default=DEFAULT_REAPER_BATCH_SIZE,
+        help="Chunks of unlinked files deleted per batch in the background")
+
+    parser.add_argument(
+        '--reaper-rate',
+        dest='reaper_rate',
+        type=float,
+        default=DEFAULT_REAPER_RATE,
+        help="Max. number of chunk delete batches per second. 0 = unlimited")
+
+    parser.add_argument(
+        '--quota',
+        type=size_type,
+        default=None,
+        help="Size reported by statfs/df, e.g. 10T. Defaults to the size of "
+             "the filesystem holding the database")
+
+    parser.add_argument(
+        '--statfs-interval',
+        dest='statfs_interval',
+        type=float,
+        default=DEFAULT_STATFS_INTERVAL,
+        help="Seconds between refreshes of the statistics reported by statfs")
+
+    parser.add_argument(
+        '--metrics-port',
+        dest='metrics_port',
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+
+    parser.add_argument(
+        '--metrics-socket',
+        dest='metrics_socket',
+        default=None,
+        help="Serve Prometheus metrics over HTTP on this unix socket, "
+             "e.g. next to the mount point")
+
+    parser.add_argument(
+        '--trace-sample-rate',
+        dest='trace_sample_rate',
+        type=float,
+        default=0,
+        help="Fraction of requests (0-1) recorded as structured trace "
+             "(op, inode/fd, latency, bytes) in a ring buffer. "
+             "Dumped as JSON lines on /trace of the metrics server, "
+             "needs --metrics-port or --metrics-socket")
+
+    parser.add_argument(
+        '--trace-buffer-size',
+        dest='trace_buffer_size',
+        type=int,
+        default=DEFAULT_TRACE_BUFFER_SIZE,
+        help="Number of trace records kept")
+
     return parser
 
 
+def start_metrics_server(ops, options):
+    if options.metrics_socket is None and options.metrics_port is None:
+        return None
+
+    server = MetricsServer(
+        ops.metrics,
+        port=options.metrics_port,
+        socket_path=options.metrics_socket,
+        tracer=ops.tracer)
+    server.start()
+    return server
+
+
 def run_fuse_mount(ops, options, mount_opts):
     mount_opts = ['fsname=gridfs_fuse'] + mount_opts
     llfuse.init(ops, options.mount_point, mount_opts)
 
     try:
-        llfuse.main(workers=1)
+        llfuse.main(workers=options.workers)
     finally:
         llfuse.close()
 
@@ -68,7 +343,12 @@ def main():
     # 'nonempty' Allow mount on non empty directory
     mount_opts = ['default_permissions']
 
-    run_fuse_mount(ops, options, mount_opts)
+    metrics_server = start_metrics_server(ops, options)
+    try:
+        run_fuse_mount(ops, options, mount_opts)
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+"""Prometheus/OpenMetrics style metrics of the filesystem.
+
+Records per request handler latency histograms, mongodb round trips per
+handler (through pymongo command monitoring), bytes read/written and
+whatever the operations register as callbacks (cache hit ratios, queue
+depths). 'MetricsServer' exposes them in the text exposition format on
+a local TCP port or a unix socket.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import socketserver
+import http.server
+
+from pymongo import monitoring
+
+
+# Seconds, from cache hits to slow round trips
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# Round trips of threads not handling a request (read-ahead, uploads, ...)
+BACKGROUND = 'background'
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Metrics(object):
+    def __init__(self):
+        # op: Histogram
+        self.latency = {}
+
+        # op: Counter
+        self.round_trips = {}
+
+        self.bytes_read = Counter()
+        self.bytes_written = Counter()
+
+        # name: (type, help, callback returning [(labels, value)])
+        self._callbacks = {}
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def track(self, op):
+        """Time a request handler, round trips within are accounted to it."""
+        outer = getattr(self._local, 'op', None)
+        self._local.op = op
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._histogram(op).observe(time.perf_counter() - start)
+            self._local.op = outer
+
+    def count_round_trip(self):
+        op = getattr(self._local, 'op', None) or BACKGROUND
+        self._counter(op).inc()
+
+    def register(self, name, type_, help_, callback):
+        self._callbacks[name] = (type_, help_, callback)
+
+    def command_listener(self):
+        return _CommandListener(self)
+
+    def _histogram(self, op):
+        histogram = self.latency.get(op)
+        if histogram is None:
+            with self._lock:
+                histogram = self.latency.setdefault(op, Histogram())
+        return histogram
+
+    def _counter(self, op):
+        counter = self.round_trips.get(op)
+        if counter is None:
+            with self._lock:
+                counter = self.round_trips.setdefault(op, Counter())
+        return counter
+
+    def render(self):
+        lines = []
+
+        name = 'gridfs_fuse_request_duration_seconds'
+        lines.append('# HELP %s Latency of FUSE request handlers' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for op, histogram in sorted(self.latency.items()):
+            with histogram._lock:
+                counts = list(histogram.counts)
+                total, count = histogram.sum, histogram.count
+
+            cumulative = 0
+            for bound, bucket in zip(histogram.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket{op="%s",le="%s"} %d' % (
+                    name, op, bound, cumulative))
+            lines.append('%s_bucket{op="%s",le="+Inf"} %d' % (name, op, count))
+            lines.append('%s_sum{op="%s"} %r' % (name, op, total))
+            lines.append('%s_count{op="%s"} %d' % (name, op, count))
+
+        name = 'gridfs_fuse_mongodb_round_trips_total'
+        lines.append('# HELP %s MongoDB commands sent per FUSE request type' % name)
+        lines.append('# TYPE %s counter' % name)
+        for op, counter in sorted(self.round_trips.items()):
+            lines.append('%s{op="%s"} %d' % (name, op, counter.value))
+
+        for name, help_, counter in (
+                ('gridfs_fuse_read_bytes_total', 'Bytes read', self.bytes_read),
+                ('gridfs_fuse_written_bytes_total', 'Bytes written', self.bytes_written)):
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %d' % (name, counter.value))
+
+        for name, (type_, help_, callback) in sorted(self._callbacks.items()):
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, type_))
+            for labels, value in callback():
+                lines.append('%s%s %r' % (name, _format_labels(labels), value))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('%s="%s"' % item for item in sorted(labels.items()))
+    return '{%s}' % pairs
+
+
+class _CommandListener(monitoring.CommandListener):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        self.metrics.count_round_trip()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in ('/', '/metrics'):
+            body = self.server.metrics.render()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/trace' and self.server.tracer is not None:
+            body = self.server.tracer.dump()
+            content_type = 'application/x-ndjson'
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return str(self.client_address or 'unix')
+
+    def log_message(self, format, *args):
+        logging.getLogger("gridfs_fuse").debug(format, *args)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """Serves the metrics on 127.0.0.1:port or on a unix socket.
+
+    '/trace' dumps the ring buffer of the tracer (if tracing is enabled).
+    """
+
+    def __init__(self, metrics, port=None, socket_path=None, tracer=None):
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.server = _UnixServer(socket_path, _Handler)
+        else:
+            self.server = _TCPServer(('127.0.0.1', port), _Handler)
+
+        self.socket_path = socket_path
+        self.server.metrics = metrics
+        self.server.tracer = tracer
+        self._thread = threading.Thread(
+            target=self.server.serve_forever,
+            name="gridfs_fuse-metrics",
+            daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socket_path is not None:
+            os.unlink(self.socket_path)
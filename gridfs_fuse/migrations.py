@@ -5,7 +5,74 @@ from bson import Binary
 from gridfs_fuse.pymongo_compat import compat_collection
 
 
-MAX_MIGRATION_VERSION = LooseVersion("0.3.0")
+def _migrate_binary_filenames_and_ns_timestamps(database):
+    """Filenames are stored as binary, timestamps as nanoseconds."""
+    metadata_col = compat_collection(database, 'metadata')
+    fs_files_col = compat_collection(database, 'fs.files')
+
+    for col in [fs_files_col, metadata_col]:
+        for doc in col.find({}):
+            update_fields = {}
+            unset_fields = {}
+            # Filename conversion
+            if "filename" in doc and isinstance(doc["filename"], str):
+                update_fields["filename"] = Binary(doc["filename"].encode())
+
+            # Timestamp fields migration
+            for ts_field in ['atime', 'mtime', 'ctime']:
+                if ts_field in doc:
+                    update_fields[f"{ts_field}_ns"] = int(doc[ts_field] * 1e6)
+                    unset_fields[ts_field] = ""
+
+            if update_fields:
+                col.update_one(
+                    {"_id": doc["_id"]},
+                    {"$set": update_fields, "$unset": unset_fields}
+                )
+
+
+def _migrate_file_sizes(database):
+    """Copy length, chunkSize and md5 of every file into its inode."""
+    metadata_col = compat_collection(database, 'metadata')
+    fs_files_col = compat_collection(database, 'fs.files')
+
+    for doc in fs_files_col.find({}):
+        update_fields = {
+            "length": doc["length"],
+            "chunk_size": doc["chunkSize"]
+        }
+        if doc.get("md5") is not None:
+            update_fields["md5"] = doc["md5"]
+
+        metadata_col.update_one(
+            {"_id": doc["_id"]},
+            {"$set": update_fields}
+        )
+
+
+def _migrate_drop_directory_childs(database):
+    """Folders are resolved by the (parent_inode, filename) index.
+
+    The 'childs' array within folders is not used anymore.
+    """
+    metadata_col = compat_collection(database, 'metadata')
+
+    for doc in metadata_col.find({"childs": {"$exists": True}}, {"_id": 1}):
+        metadata_col.update_one(
+            {"_id": doc["_id"]},
+            {"$unset": {"childs": ""}}
+        )
+
+
+# (version, migration) sorted by version.
+# A migration runs if the database was last touched by an older version.
+MIGRATIONS = [
+    (LooseVersion("0.3.0"), _migrate_binary_filenames_and_ns_timestamps),
+    (LooseVersion("0.4.0"), _migrate_file_sizes),
+    (LooseVersion("0.5.0"), _migrate_drop_directory_childs),
+]
+
+MAX_MIGRATION_VERSION = MIGRATIONS[-1][0]
 
 
 def perform_startup_migrations(database):
@@ -20,33 +87,15 @@ def perform_startup_migrations(database):
     """
 
     meta_col = compat_collection(database, 'meta')
-    metadata_col = compat_collection(database, 'metadata')
-    fs_files_col = compat_collection(database, 'fs.files')
 
     version_doc = meta_col.find_one({"_id": "version"})
     version = version_doc["value"] if version_doc else "0.0.0"
     version = LooseVersion(version)
 
     if version < MAX_MIGRATION_VERSION:
-        for col in [fs_files_col, metadata_col]:
-            for doc in col.find({}):
-                update_fields = {}
-                unset_fields = {}
-                # Filename conversion
-                if "filename" in doc and isinstance(doc["filename"], str):
-                    update_fields["filename"] = Binary(doc["filename"].encode())
-
-                # Timestamp fields migration
-                for ts_field in ['atime', 'mtime', 'ctime']:
-                    if ts_field in doc:
-                        update_fields[f"{ts_field}_ns"] = int(doc[ts_field] * 1e6)
-                        unset_fields[ts_field] = ""
-
-                if update_fields:
-                    col.update_one(
-                        {"_id": doc["_id"]},
-                        {"$set": update_fields, "$unset": unset_fields}
-                    )
+        for migration_version, migration in MIGRATIONS:
+            if version < migration_version:
+                migration(database)
 
         meta_col.update_one(
             {"_id": "version"},
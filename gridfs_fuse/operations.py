@@ -3,14 +3,40 @@ import os
 import stat
 import time
 import errno
-import collections
+import contextlib
+import copy
+import functools
 import threading
 
 import llfuse
 import gridfs
 
 import pymongo
+from bson.binary import Binary
 from .pymongo_compat import compat_collection
+from .cache import LRUCache
+from .cache import ChangeStreamWatcher
+from .cache import ChunkCache
+from .read_ahead import ChunkFetcher
+from .read_ahead import ChunkReader
+from .read_ahead import InlineReader
+from .read_ahead import MissingChunk
+from .write_behind import ChunkUploader
+from .write_behind import ChunkWriter
+from .write_behind import UploadFailed
+from .filename_sync import FilenameRewriter
+from .dedup import BlockStore
+from . import compression
+from .group_commit import GroupCommitter
+from .group_commit import DUPLICATE_KEY
+from .group_commit import DEFAULT_WINDOW as DEFAULT_GROUP_COMMIT_WINDOW
+from .reaper import ChunkReaper
+from .reaper import DEFAULT_BATCH_SIZE as DEFAULT_REAPER_BATCH_SIZE
+from .reaper import DEFAULT_BATCHES_PER_SECOND as DEFAULT_REAPER_RATE
+from .statfs import FilesystemStats
+from .statfs import DEFAULT_INTERVAL as DEFAULT_STATFS_INTERVAL
+from .metrics import Metrics
+from .tracing import Tracer
 
 from distutils.version import LooseVersion
 
@@ -20,16 +46,61 @@ mask = stat.S_IWGRP | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
 
 RETRY_WRITES_MIN_VERSION = LooseVersion("3.6")
 
+READDIR_BATCH_SIZE = 1000
 
-def create_mongo_client(mongodb_uri):
+DEFAULT_METADATA_CACHE_SIZE = 100000
+DEFAULT_METADATA_CACHE_TTL = 1.0
+DEFAULT_NEGATIVE_LOOKUP_TTL = 1.0
+
+DEFAULT_CHUNK_CACHE_SIZE = 256 * 1024 * 1024
+DEFAULT_READ_AHEAD = 8
+READ_AHEAD_WORKERS = 4
+
+DEFAULT_CHUNK_SIZE = gridfs.DEFAULT_CHUNK_SIZE
+
+# Seconds the kernel may cache names, attributes and failed lookups
+DEFAULT_ENTRY_TIMEOUT = 10
+DEFAULT_ATTR_TIMEOUT = 10
+DEFAULT_NEGATIVE_TIMEOUT = 0
+
+DEFAULT_INODE_BLOCK_SIZE = 1024
+
+# A chunk document must stay below the 16 MB BSON limit
+MAX_CHUNK_SIZE = 15 * 1024 * 1024
+
+# Folder settings for new files within, inherited by subfolders.
+# Files report the values they got written with.
+XATTR_CHUNK_SIZE = b'user.gridfs.chunk_size'
+XATTR_COMPRESSION = b'user.gridfs.compression'
+
+# xattr: Entry field
+XATTR_FIELDS = {
+    XATTR_CHUNK_SIZE: 'chunk_size',
+    XATTR_COMPRESSION: 'compression',
+}
+
+DEFAULT_WRITE_BUFFER_SIZE = 64 * 1024 * 1024
+UPLOAD_WORKERS = 2
+
+# Files up to this size are kept within their inode document, 0 = never.
+# Same BSON limit as for chunks.
+DEFAULT_INLINE_THRESHOLD = 0
+MAX_INLINE_THRESHOLD = MAX_CHUNK_SIZE
+
+
+def create_mongo_client(mongodb_uri, event_listeners=None):
     logger = logging.getLogger("gridfs_fuse")
 
     old_pymongo = LooseVersion(pymongo.version) < RETRY_WRITES_MIN_VERSION
 
+    kwargs = {}
+    if event_listeners:
+        kwargs['event_listeners'] = event_listeners
+
     if old_pymongo:
-        client = pymongo.MongoClient(mongodb_uri)
+        client = pymongo.MongoClient(mongodb_uri, **kwargs)
     else:
-        client = pymongo.MongoClient(mongodb_uri, retryWrites=True)
+        client = pymongo.MongoClient(mongodb_uri, retryWrites=True, **kwargs)
 
     compat_version = get_compat_version(client)
     if old_pymongo or compat_version < RETRY_WRITES_MIN_VERSION:
@@ -46,8 +117,52 @@ def create_mongo_client(mongodb_uri):
     return client
 
 
-def grid_in_size(grid_in):
-    return grid_in._position + grid_in._buffer.tell()
+def global_lock_released(method):
+    """Run a request handler without holding the global llfuse lock.
+
+    Only done if the filesystem runs with several workers,
+    otherwise there is nothing to gain.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._global_lock_released():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def instrumented(method):
+    """Record latency and mongodb round trips of a request handler.
+
+    With tracing enabled a sample of the calls is also recorded with
+    its first argument (inode or fd) and the bytes read/written.
+    Without metrics (no endpoint to serve them) the handler runs bare.
+    """
+    op = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.metrics is None:
+            return method(self, *args, **kwargs)
+
+        if self.tracer is None or not self.tracer.sample():
+            with self.metrics.track(op):
+                return method(self, *args, **kwargs)
+
+        start = time.perf_counter()
+        with self.metrics.track(op):
+            result = method(self, *args, **kwargs)
+
+        if op == 'read':
+            nbytes = len(result)
+        elif op == 'write':
+            nbytes = len(args[2])
+        else:
+            nbytes = 0
+
+        self.tracer.record(op, args[0] if args else None,
+                           time.perf_counter() - start, nbytes)
+        return result
+    return wrapper
 
 
 class EntryNotFound(Exception):
@@ -57,9 +172,15 @@ class EntryNotFound(Exception):
 
 
 class Entry(object):
-    def __init__(self, ops, filename, inode, parent_inode, mode, uid, gid):
-        self._ops = ops
-
+    # Millions of entries get cached, no per instance __dict__.
+    # These are also the fields of an inode document, see ENTRY_PROJECTION.
+    __slots__ = (
+        '_id', 'filename', 'parent_inode', 'mode', 'uid', 'gid',
+        'atime_ns', 'mtime_ns', 'ctime_ns',
+        'length', 'chunk_size', 'md5', 'inline', 'compression'
+    )
+
+    def __init__(self, filename, inode, parent_inode, mode, uid, gid):
         self._id = inode
         self.filename = filename
         self.parent_inode = parent_inode
@@ -69,15 +190,44 @@ class Entry(object):
 
         self.atime_ns = self.mtime_ns = self.ctime_ns = int(time.time_ns())
 
-        # Only for directories
-        # filename: inode
-        self.childs = {}
+        # Only for files, recorded once the file is closed
+        self.length = None
+        self.chunk_size = None
+        self.md5 = None
+
+        # True => content is the field 'data' of the inode, not in gridfs
+        self.inline = None
+
+        # Codec of the chunks (see compression.py), None => uncompressed
+        self.compression = None
 
     @property
     def inode(self):
         return self._id
 
 
+# Only what an Entry holds, fields added by others are not transferred
+ENTRY_PROJECTION = dict.fromkeys(Entry.__slots__, True)
+
+# Lookups by name usually precede an open => take the content along
+INLINE_ENTRY_PROJECTION = dict(ENTRY_PROJECTION, data=True)
+
+# Existence checks, covered by the (parent_inode, _id) index
+ID_PROJECTION = {'_id': True}
+
+# Change events carry only what the cache invalidation looks at
+METADATA_CHANGE_PIPELINE = [{
+    '$project': {
+        'operationType': True,
+        'documentKey': True,
+        'fullDocument.parent_inode': True,
+        'fullDocument.filename': True,
+        'updateDescription.updatedFields.parent_inode': True,
+        'updateDescription.updatedFields.filename': True,
+    }
+}]
+
+
 class FileDescriptorFactory(object):
     def __init__(self):
         self.lock = threading.Lock()
@@ -100,145 +250,610 @@ class FileDescriptorFactory(object):
                 self.next_fd = 1
 
 
+class InodeAllocator(object):
+    """Hands out inodes from ranges leased from the 'next_inode' document.
+
+    One round trip per 'block_size' inodes instead of one per create.
+    Unused inodes of a lease (e.g. on unmount) are simply never used.
+    """
+    def __init__(self, meta, block_size):
+        self.meta = meta
+        self.block_size = block_size
+
+        self.lock = threading.Lock()
+        self.next_inode = 0
+        self.end_inode = 0
+
+    def gen(self):
+        with self.lock:
+            if self.next_inode >= self.end_inode:
+                query = {"_id": "next_inode"}
+                update = {"$inc": {"value": self.block_size}}
+                doc = self.meta.find_one_and_update(
+                    query, update, projection={'value': True})
+
+                self.next_inode = doc['value']
+                self.end_inode = self.next_inode + self.block_size
+
+            inode = self.next_inode
+            self.next_inode += 1
+            return inode
+
+
 class Operations(llfuse.Operations):
-    def __init__(self, database):
+    def __init__(self, database,
+                 metadata_cache_size=DEFAULT_METADATA_CACHE_SIZE,
+                 metadata_cache_ttl=DEFAULT_METADATA_CACHE_TTL,
+                 negative_lookup_ttl=DEFAULT_NEGATIVE_LOOKUP_TTL,
+                 workers=1,
+                 chunk_cache_size=DEFAULT_CHUNK_CACHE_SIZE,
+                 read_ahead=DEFAULT_READ_AHEAD,
+                 write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 inline_threshold=DEFAULT_INLINE_THRESHOLD,
+                 dedup=False,
+                 compression=None,
+                 entry_timeout=DEFAULT_ENTRY_TIMEOUT,
+                 attr_timeout=DEFAULT_ATTR_TIMEOUT,
+                 negative_timeout=DEFAULT_NEGATIVE_TIMEOUT,
+                 inode_block_size=DEFAULT_INODE_BLOCK_SIZE,
+                 group_commit_window=DEFAULT_GROUP_COMMIT_WINDOW,
+                 reaper_batch_size=DEFAULT_REAPER_BATCH_SIZE,
+                 reaper_rate=DEFAULT_REAPER_RATE,
+                 quota=None,
+                 statfs_interval=DEFAULT_STATFS_INTERVAL,
+                 metrics=None,
+                 tracer=None):
         super(Operations, self).__init__()
 
         self.logger = logging.getLogger("gridfs_fuse")
 
+        # Evaluated once, debug logging costs nothing on hot paths otherwise
+        self.debug = self.logger.isEnabledFor(logging.DEBUG)
+        self.tracer = tracer
+
+        # With several workers the handlers run concurrently while waiting
+        # for mongodb. Everything shared between them must be thread safe.
+        self.workers = workers
+
         self.meta = compat_collection(database, 'metadata')
         self.gridfs = gridfs.GridFS(database)
         self.gridfs_files = compat_collection(database, 'fs.files')
+        self.gridfs_chunks = compat_collection(database, 'fs.chunks')
+
+        # inode: Entry
+        # Kept coherent with other nodes by the change stream watcher.
+        # Without change streams entries expire after 'metadata_cache_ttl'.
+        self.metadata_cache_ttl = metadata_cache_ttl
+        self.entry_cache = LRUCache(metadata_cache_size, metadata_cache_ttl)
+        self.metadata_watcher = None
+
+        # (folder_inode, filename): inode
+        # inode 0 caches a failed lookup for 'negative_lookup_ttl' seconds.
+        # Positive entries are verified against the entry cache.
+        self.negative_lookup_ttl = negative_lookup_ttl
+        self.name_cache = LRUCache(metadata_cache_size, metadata_cache_ttl)
+
+        # folder inode: full path of the folder
+        # Dropped completely if any folder gets renamed/moved,
+        # since the paths of all its descendants change.
+        self.path_cache = LRUCache(metadata_cache_size, metadata_cache_ttl)
+
+        self.entry_timeout = entry_timeout
+        self.attr_timeout = attr_timeout
+        self.negative_timeout = negative_timeout
+
+        self.inode_allocator = InodeAllocator(self.meta, inode_block_size)
+
+        # Inserts of new entries and sizes of closed files from concurrent
+        # requests are written together, see group_commit.py.
+        # A window of 0 sends every write right away.
+        self.group_committer = GroupCommitter(self.meta, group_commit_window)
 
         # For syscalls which return a 'file handle'.
         # This handle is used later to associate successive calls.
         self.fd_factory = FileDescriptorFactory()
 
-        # Mapping between fd: GridFile
+        # Codec of new files, unless their folder overrides it.
+        self.compression = compression
+
+        # Data of deduplicated chunks, shared between files.
+        # Files written with 'dedup' are not readable by other gridfs tools.
+        self.dedup = dedup
+        self.block_store = BlockStore(compat_collection(database, 'blocks'))
+
+        # Chunks are shared between all readers.
+        # 'read_ahead' chunks are prefetched on sequential reads.
+        self.read_ahead = read_ahead
+        self.chunk_cache = ChunkCache(chunk_cache_size)
+        self.chunk_fetcher = ChunkFetcher(
+            self.gridfs_chunks,
+            self.chunk_cache,
+            READ_AHEAD_WORKERS,
+            self.block_store)
+
+        # Chunk size of new files, unless their folder overrides it.
+        self.chunk_size = chunk_size
+
+        # Files up to 'inline_threshold' bytes are kept within their inode.
+        # Their content is cached in the chunk cache as chunk 0.
+        self.inline_threshold = inline_threshold
+
+        # Chunks of written files are uploaded in the background.
+        # Writers block once 'write_buffer_size' bytes wait for the upload.
+        self.chunk_uploader = ChunkUploader(
+            self.gridfs_chunks,
+            self.gridfs_files,
+            write_buffer_size,
+            UPLOAD_WORKERS,
+            self.block_store if dedup else None)
+
+        # Chunks of unlinked files are deleted in the background
+        self.reaper = ChunkReaper(
+            compat_collection(database, 'reaper'),
+            self.gridfs_chunks,
+            self.block_store,
+            reaper_batch_size,
+            reaper_rate)
+
+        # statfs answers from statistics refreshed in the background
+        self.fs_stats = FilesystemStats(database, quota, statfs_interval)
+
+        # gridfs filenames below moved folders are fixed in the background
+        self.filename_rewriter = FilenameRewriter(self.meta, self.gridfs_files)
+
+        # Mapping between fd: ChunkWriter / ChunkReader
         self.active_writes = {}
         self.active_reads = {}
 
+        # Round trips are only counted if 'metrics' is also registered as
+        # event listener of the mongo client (see operations_factory).
+        # None => nothing is recorded, request handlers pay nothing for it.
+        self.metrics = metrics
+        if self.metrics is not None:
+            self._register_metrics()
+
+        # Serializes writes and the release of the same fd.
+        # Reads are positional and take no lock.
+        self.fd_locks = {}
+
+    def init(self):
+        self.reaper.start()
+        self.fs_stats.start()
+
+        if self.entry_cache.maxsize > 0:
+            self.metadata_watcher = ChangeStreamWatcher(
+                self.meta,
+                self._on_metadata_change,
+                self._on_metadata_watch_reset,
+                METADATA_CHANGE_PIPELINE)
+            self.metadata_watcher.start()
+
+    def destroy(self):
+        if self.metadata_watcher is not None:
+            self.metadata_watcher.stop()
+
+        self.chunk_fetcher.shutdown()
+        self.chunk_uploader.shutdown()
+        self.filename_rewriter.shutdown()
+        self.reaper.stop()
+        self.fs_stats.stop()
+
+        self.logger.info("metadata cache: %s", self.entry_cache.stats())
+        self.logger.info("name cache: %s", self.name_cache.stats())
+        self.logger.info("chunk cache: %s", self.chunk_cache.stats())
+
+    def _track(self, op):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.track(op)
+
+    def _register_metrics(self):
+        caches = {
+            'entry': self.entry_cache,
+            'name': self.name_cache,
+            'path': self.path_cache,
+            'chunk': self.chunk_cache
+        }
+
+        self.metrics.register(
+            'gridfs_fuse_cache_hits_total',
+            'counter',
+            'Cache hits',
+            lambda: [({'cache': n}, c.hits) for n, c in caches.items()])
+
+        self.metrics.register(
+            'gridfs_fuse_cache_misses_total',
+            'counter',
+            'Cache misses',
+            lambda: [({'cache': n}, c.misses) for n, c in caches.items()])
+
+        self.metrics.register(
+            'gridfs_fuse_chunk_cache_bytes',
+            'gauge',
+            'Bytes within the chunk cache',
+            lambda: [(None, self.chunk_cache.size)])
+
+        self.metrics.register(
+            'gridfs_fuse_open_files',
+            'gauge',
+            'Open file descriptors',
+            lambda: [
+                ({'mode': 'read'}, len(self.active_reads)),
+                ({'mode': 'write'}, len(self.active_writes))
+            ])
+
+        self.metrics.register(
+            'gridfs_fuse_upload_queue_chunks',
+            'gauge',
+            'Chunks waiting for their upload',
+            lambda: [(None, self.chunk_uploader.qsize())])
+
+        self.metrics.register(
+            'gridfs_fuse_upload_buffer_bytes',
+            'gauge',
+            'Bytes of chunks waiting for their upload',
+            lambda: [(None, self.chunk_uploader.budget.used)])
+
+        self.metrics.register(
+            'gridfs_fuse_reaper_queue_files',
+            'gauge',
+            'Unlinked files whose chunks are not deleted yet',
+            lambda: [(None, self.reaper.pending())])
+
+        self.metrics.register(
+            'gridfs_fuse_filename_rewrite_jobs',
+            'gauge',
+            'Moved folders whose gridfs filenames are not rewritten yet',
+            lambda: [(None, self.filename_rewriter.pending())])
+
+        self.metrics.register(
+            'gridfs_fuse_dedup_saved_bytes_total',
+            'counter',
+            'Written bytes not sent since their block existed already',
+            lambda: [(None, self.block_store.saved_bytes)])
+
+        self.metrics.register(
+            'gridfs_fuse_group_commit_batches_total',
+            'counter',
+            'Bulk writes of grouped metadata writes',
+            lambda: [(None, self.group_committer.batches)])
+
+        self.metrics.register(
+            'gridfs_fuse_group_commit_writes_total',
+            'counter',
+            'Metadata writes sent within a group',
+            lambda: [(None, self.group_committer.requests)])
+
+    def _on_metadata_change(self, change):
+        if 'documentKey' not in change:
+            # drop, rename, invalidate of the whole collection
+            self.entry_cache.clear()
+            self.name_cache.clear()
+            self.path_cache.clear()
+            return
+
+        inode = change['documentKey']['_id']
+        self.entry_cache.invalidate(inode)
+
+        if change['operationType'] == 'delete':
+            self.path_cache.invalidate(inode)
+        elif self._is_move(change):
+            self.path_cache.clear()
+
+        # A new name might shadow a cached negative lookup.
+        doc = change.get('fullDocument')
+        if doc and 'parent_inode' in doc:
+            self.name_cache.invalidate((doc['parent_inode'], doc['filename']))
+
+    def _is_move(self, change):
+        if change['operationType'] == 'replace':
+            return True
+
+        if change['operationType'] != 'update':
+            return False
+
+        # Projected away if neither field changed
+        updated = change.get('updateDescription', {}).get('updatedFields', {})
+        return 'parent_inode' in updated or 'filename' in updated
+
+    def _on_metadata_watch_reset(self, watching):
+        # While the change stream delivers invalidations entries can live
+        # until they are evicted, otherwise fall back to the TTL.
+        ttl = None if watching else self.metadata_cache_ttl
+        for cache in (self.entry_cache, self.name_cache, self.path_cache):
+            cache.ttl = ttl
+            cache.clear()
+
+    def _global_lock_released(self):
+        if self.workers > 1:
+            return llfuse.lock_released
+        return contextlib.nullcontext()
+
+    @instrumented
+    @global_lock_released
     def open(self, inode, flags, ctx):
-        self.logger.debug("open: %s %s", inode, flags)
+        if self.debug:
+            self.logger.debug("open: %s %s", inode, flags)
 
         # Do not allow writes to a existing file
         if flags & os.O_WRONLY:
             raise llfuse.FUSEError(errno.EACCES)
 
-        try:
-            reader = self.gridfs.get(inode)
-        except gridfs.errors.NoFile:
-            msg = "Read of inode (%s) fails. Gridfs object not found"
-            self.logger.error(msg, inode)
-            raise llfuse.FUSEError(errno.EIO)
+        # llfuse replies to every open with 'keep_cache' set, so the page
+        # cache of a file survives close/open. Fine, since files are
+        # immutable once closed. While a file is written its attributes
+        # are not cached (see _gen_attr), so its growth is noticed.
+
+        entry = self._entry_by_inode(inode)
+        if entry.inline:
+            reader = InlineReader(self._inline_data(inode))
+        else:
+            reader = self._create_reader(entry)
 
         fd = self.fd_factory.gen()
+        self.fd_locks[fd] = threading.Lock()
         self.active_reads[fd] = reader
 
         return fd
 
+    def _create_reader(self, entry):
+        length, chunk_size = entry.length, entry.chunk_size
+
+        # No length within the inode => file is still written
+        # (or was written by an older version).
+        if length is None:
+            try:
+                grid_out = self.gridfs.get(entry.inode)
+            except gridfs.errors.NoFile:
+                msg = "Read of inode (%s) fails. Gridfs object not found"
+                self.logger.error(msg, entry.inode)
+                raise llfuse.FUSEError(errno.EIO)
+            length, chunk_size = grid_out.length, grid_out.chunk_size
+
+        # Recorded within the inode on create. Entries of files created by
+        # an older version of this feature only have it within 'fs.files'.
+        codec = entry.compression
+        if codec is None and entry.length is None:
+            codec = (grid_out.metadata or {}).get('compression')
+
+        try:
+            if codec is not None:
+                compression.check(codec)
+        except compression.CodecUnavailable:
+            self.logger.exception("Read of inode (%s) fails", entry.inode)
+            raise llfuse.FUSEError(errno.EIO)
+
+        return ChunkReader(
+            self.chunk_fetcher,
+            entry.inode,
+            length,
+            chunk_size,
+            self.read_ahead,
+            codec)
+
+    def _inline_data(self, inode):
+        data = self.chunk_cache.get((inode, 0))
+        if data is not None:
+            return data
+
+        record = self.meta.find_one({'_id': inode}, {'data': True})
+        if record is None or record.get('data') is None:
+            self.logger.error("Inline content of inode (%s) not found", inode)
+            raise llfuse.FUSEError(errno.EIO)
+
+        data = bytes(record['data'])
+        self.chunk_cache.put((inode, 0), data)
+        return data
+
     def opendir(self, inode, ctx):
         """Just to check access, dont care about access => return inode"""
-        self.logger.debug("opendir: %s", inode)
+        if self.debug:
+            self.logger.debug("opendir: %s", inode)
         return inode
 
     def access(self, inode, mode, ctx):
         """Again this fs does not care about access"""
-        self.logger.debug("access: %s %s %s", inode, mode, ctx)
+        if self.debug:
+            self.logger.debug("access: %s %s %s", inode, mode, ctx)
         return True
 
+    @instrumented
+    @global_lock_released
     def getattr(self, inode, ctx):
-        self.logger.debug("getattr: %s", inode)
+        if self.debug:
+            self.logger.debug("getattr: %s", inode)
         return self._gen_attr(self._entry_by_inode(inode))
 
     def readdir(self, inode, off):
-        self.logger.debug("readdir: %s %s", inode, off)
+        if self.debug:
+            self.logger.debug("readdir: %s %s", inode, off)
 
-        entry = self._entry_by_inode(inode)
+        # Children are listed in inode order => 'off' is the last inode
+        # returned so far.
+        # Yield with the global lock held, llfuse expects that.
+        while True:
+            with self._track('readdir'), self._global_lock_released():
+                children, sizes = self._children_after(inode, off)
 
-        for child_inode in sorted(entry.childs.values()):
-            if child_inode <= off:
-                continue
+            for child in children:
+                attr = self._gen_attr(child, sizes.get(child.inode))
+                yield (child.filename, attr, child.inode)
 
-            try:
-                child = self._entry_by_inode(child_inode)
-            except EntryNotFound:
-                # Looks like entry got deleted while iterating over the folder
+            if len(children) < READDIR_BATCH_SIZE:
+                return
+
+            off = children[-1].inode
+
+    def _children_after(self, folder_inode, off):
+        # One query for the entries, at most one for the sizes.
+        token = self.entry_cache.token()
+
+        query = {
+            'parent_inode': folder_inode,
+            '_id': {'$gt': off, '$ne': folder_inode}
+        }
+        cursor = self.meta.find(query, ENTRY_PROJECTION)
+        cursor = cursor.sort('_id', pymongo.ASCENDING)
+        children = [
+            self._doc_to_entry(doc)
+            for doc in cursor.limit(READDIR_BATCH_SIZE)
+        ]
+
+        for child in children:
+            self.entry_cache.put(child.inode, child, token)
+
+        return children, self._batch_entry_sizes(children)
+
+    def _batch_entry_sizes(self, entries):
+        # Sizes of files without a recorded length with one query.
+        # See '_get_entry_size' for the details.
+        sizes = {}
+        missing = []
+        for entry in entries:
+            if stat.S_ISDIR(entry.mode) or entry.length is not None:
                 continue
 
-            item = (child.filename, self._gen_attr(child), child_inode)
-            yield item
+            size = self._active_write_size(entry.inode)
+            if size is None:
+                missing.append(entry.inode)
+            else:
+                sizes[entry.inode] = size
+
+        if missing:
+            query = {'_id': {'$in': missing}}
+            for doc in self.gridfs_files.find(query, {'length': 1}):
+                sizes[doc['_id']] = doc['length']
+
+            for inode in missing:
+                sizes.setdefault(inode, 0)
+
+        return sizes
 
+    @instrumented
+    @global_lock_released
     def lookup(self, folder_inode, name, ctx):
-        self.logger.debug("lookup: %s %s", folder_inode, name)
+        if self.debug:
+            self.logger.debug("lookup: %s %s", folder_inode, name)
 
         if name == '.':
             inode = folder_inode
 
         elif name == '..':
-            entry = self._entry_by_inode(folder_inode)
-            inode = entry.parent_inode
+            inode = self._parent_inode(folder_inode)
 
         else:
-            entry = self._entry_by_inode(folder_inode)
-            for fn, inode in entry.childs.items():
-                if fn == name:
-                    break
-            else:
-                raise llfuse.FUSEError(errno.ENOENT)
+            entry = self._child_entry(folder_inode, name, with_data=True)
+            if entry is None:
+                return self._negative_lookup()
+            return self._gen_attr(entry)
+
+        return self._gen_attr(self._entry_by_inode(inode))
 
-        return self.getattr(inode, ctx)
+    def _negative_lookup(self):
+        if not self.negative_timeout:
+            raise llfuse.FUSEError(errno.ENOENT)
+
+        # Inode 0 => the kernel caches the failure for 'entry_timeout'
+        attr = llfuse.EntryAttributes()
+        attr.st_ino = 0
+        attr.entry_timeout = self.negative_timeout
+        return attr
 
     def mknod(self, inode_p, name, mode, rdev, ctx):
-        self.logger.debug("mknod")
+        if self.debug:
+            self.logger.debug("mknod")
         raise llfuse.FUSEError(errno.ENOSYS)
 
+    @instrumented
+    @global_lock_released
     def mkdir(self, folder_inode, name, mode, ctx):
-        self.logger.debug("mkdir: %s %s %s %s", folder_inode, name, mode, ctx)
+        if self.debug:
+            self.logger.debug("mkdir: %s %s %s %s", folder_inode, name, mode, ctx)
         entry = self._create_entry(folder_inode, name, mode, ctx)
         return self._gen_attr(entry)
 
+    @instrumented
+    @global_lock_released
     def create(self, folder_inode, name, mode, flags, ctx):
-        self.logger.debug("create: %s %s %s %s", folder_inode, name, mode, flags)
+        if self.debug:
+            self.logger.debug("create: %s %s %s %s", folder_inode, name, mode, flags)
 
         entry = self._create_entry(folder_inode, name, mode, ctx)
 
         fd = self.fd_factory.gen()
-        self.active_writes[fd] = self._create_grid_in(entry)
+        self.fd_locks[fd] = threading.Lock()
+        self.active_writes[fd] = self._create_writer(entry)
 
         return (fd, self._gen_attr(entry))
 
-    def _create_grid_in(self, entry):
-        gridfs_filename = self._create_full_path(entry)
-        return self.gridfs.new_file(_id=entry.inode, filename=gridfs_filename)
+    def _create_writer(self, entry):
+        return ChunkWriter(
+            self.chunk_uploader,
+            entry.inode,
+            self._create_full_path(entry),
+            entry.chunk_size,
+            self.inline_threshold,
+            entry.compression)
 
     def _create_full_path(self, entry):
         # Build the full path for this file.
         # Add the full path to make other tools like
         # mongofiles, mod_gridfs, ngx_gridfs happy
-        path = collections.deque()
-        while entry._id != llfuse.ROOT_INODE:
-            path.appendleft(entry.filename)
-            entry = self._entry_by_inode(entry.parent_inode)
-        path.appendleft(entry.filename)
-        return os.path.join(*path)
+        if entry.inode == llfuse.ROOT_INODE:
+            return entry.filename
+
+        folder_path = self._folder_path(entry.parent_inode)
+        return os.path.join(folder_path, entry.filename)
+
+    def _folder_path(self, inode):
+        # Only a cache miss walks up the tree, caching every ancestor.
+        path = self.path_cache.get(inode)
+        if path is not None:
+            return path
+
+        token = self.path_cache.token()
+        path = self._create_full_path(self._entry_by_inode(inode))
+        self.path_cache.put(inode, path, token)
+        return path
 
     def _create_entry(self, folder_inode, name, mode, ctx):
         inode = self._gen_inode()
-        entry = Entry(self, name, inode, folder_inode, mode, ctx.uid, ctx.gid)
-
-        self._insert_entry(entry)
+        entry = Entry(name, inode, folder_inode, mode, ctx.uid, ctx.gid)
+
+        # For folders 'chunk_size' and 'compression' are the ones of new
+        # files within. Subfolders inherit them.
+        # Files record theirs right away, readers of a file whose inode
+        # is not completed yet must still know how its chunks look.
+        folder = self._entry_by_inode(folder_inode)
+        if stat.S_ISDIR(mode):
+            entry.chunk_size = folder.chunk_size
+            entry.compression = folder.compression
+        else:
+            entry.chunk_size = folder.chunk_size or self.chunk_size
+            entry.compression = folder.compression or self.compression
+            if entry.compression == compression.NONE:
+                entry.compression = None
 
-        query = {"_id":  folder_inode}
-        update = {"$addToSet": {"childs": (name, inode)}}
-        self.meta.update_one(query, update)
+        # The unique index (parent_inode, filename) protects against
+        # two entries with the same name within a folder.
+        try:
+            self._insert_entry(entry)
+        except pymongo.errors.DuplicateKeyError:
+            raise llfuse.FUSEError(errno.EEXIST)
+        finally:
+            self.name_cache.invalidate((folder_inode, name))
 
         return entry
 
+    @instrumented
+    @global_lock_released
     def setattr(self, inode, attr, fields, fh, ctx):
-        self.logger.debug("setattr: %s", inode)
+        if self.debug:
+            self.logger.debug("setattr: %s", inode)
 
-        entry = self._entry_by_inode(inode)
+        # Never modify the cached instance in place.
+        entry = copy.copy(self._entry_by_inode(inode))
 
         # No way to change the size of an existing file.
         if fields.update_size:
@@ -252,25 +867,34 @@ class Operations(llfuse.Operations):
             'st_mtime_ns' if fields.update_mtime else None
         ]
 
+        changed = []
         for attr_name in filter(bool, to_set):
             val = getattr(attr, attr_name, None)
             if val is not None:
                 target = attr_name[3:]
                 setattr(entry, target, val)
+                changed.append(target)
 
-        self._update_entry(entry)
+        if changed:
+            self._update_entry(entry, changed)
         return self._gen_attr(entry)
 
+    @instrumented
+    @global_lock_released
     def unlink(self, folder_inode, name, ctx):
-        self.logger.debug("unlink: %s %s", folder_inode, name)
+        if self.debug:
+            self.logger.debug("unlink: %s %s", folder_inode, name)
 
         self._delete_inode(
             folder_inode,
             name,
             self._delete_inode_check_file)
 
+    @instrumented
+    @global_lock_released
     def rmdir(self, folder_inode, name, ctx):
-        self.logger.debug("rmdir: %s %s", folder_inode, name)
+        if self.debug:
+            self.logger.debug("rmdir: %s %s", folder_inode, name)
 
         self._delete_inode(
             folder_inode,
@@ -278,36 +902,29 @@ class Operations(llfuse.Operations):
             self._delete_inode_check_directory)
 
     def _delete_inode(self, folder_inode, name, entry_check):
-        # On insert the order is like this
-        # 1. write into the database.
-        #    the unique index (parent_inode, filename) protects
-        # 2. Update the folder inode
-
-        # On remove the order must be vice verca
-        # 1. Remove from the folder inode
-        # 2. Remove from the database
-
-        # In that case the unique index protection is true
-
-        parent = self._entry_by_inode(folder_inode)
-
-        if name not in parent.childs:
+        # Folders do not keep a list of their childs.
+        # Removing the document removes the entry from its folder.
+        entry = self._child_entry(folder_inode, name)
+        if entry is None:
             raise llfuse.FUSEError(errno.ENOENT)
-        inode = parent.childs[name]
 
-        entry = self._entry_by_inode(inode)
+        inode = entry.inode
         entry_check(entry)
 
-        # Remove from the folder node
-        query = {"_id": folder_inode}
-        update = {"$pull": {'childs': (name, inode)}}
-        self.meta.update_one(query, update)
-
         # Remove from the database
         self.meta.delete_one({"_id": inode})
+        self.entry_cache.invalidate(inode)
+        self.name_cache.invalidate((folder_inode, name))
+        self.path_cache.invalidate(inode)
+
+        if not stat.S_ISDIR(entry.mode) and not entry.inline:
+            self._delete_file_data(inode)
 
-        # Remove from the grids collections
-        self.gridfs.delete(inode)
+    def _delete_file_data(self, inode):
+        # Queue the chunks first => a crash can not leak them.
+        # Once the 'fs.files' document is gone gridfs does not know the file.
+        self.reaper.enqueue(inode)
+        self.gridfs_files.delete_one({"_id": inode})
 
     def _delete_inode_check_file(self, entry):
         if stat.S_ISDIR(entry.mode):
@@ -317,169 +934,437 @@ class Operations(llfuse.Operations):
         if not stat.S_ISDIR(entry.mode):
             raise llfuse.FUSEError(errno.ENOTDIR)
 
-        if len(entry.childs) > 0:
+        if self._has_children(entry.inode):
             raise llfuse.FUSEError(errno.ENOTEMPTY)
 
+    @instrumented
+    @global_lock_released
     def read(self, fd, offset, length):
-        self.logger.debug("read: %s %s %s", fd, offset, length)
+        if self.debug:
+            self.logger.debug("read: %s %s %s", fd, offset, length)
 
-        if fd not in self.active_reads:
+        reader = self.active_reads.get(fd)
+        if reader is None:
             self.logger.error("wrong fd on read: %s %s %s", fd, offset, length)
             raise llfuse.FUSEError(errno.EINVAL)
 
-        grid_out = self.active_reads[fd]
+        # Readers are positional, concurrent reads of one fd need no lock.
+        try:
+            data = reader.read(offset, length)
+        except (MissingChunk, compression.CodecUnavailable):
+            self.logger.exception("read failed: %s %s %s", fd, offset, length)
+            raise llfuse.FUSEError(errno.EIO)
 
-        grid_out.seek(offset)
-        return grid_out.read(length)
+        if self.metrics is not None:
+            self.metrics.bytes_read.inc(len(data))
+        return data
 
+    @instrumented
+    @global_lock_released
     def write(self, fd, offset, data):
         # Only 'append once' semantics are supported.
-        self.logger.debug("write: %s %s %s", fd, offset, len(data))
+        if self.debug:
+            self.logger.debug("write: %s %s %s", fd, offset, len(data))
 
-        if fd not in self.active_writes:
+        writer = self.active_writes.get(fd)
+        if writer is None:
             self.logger.error("wrong fd on write: %s %s %s", fd, offset, len(data))
             raise llfuse.FUSEError(errno.EINVAL)
 
-        grid_in = self.active_writes[fd]
+        with self.fd_locks[fd]:
+            if offset != writer.length:
+                raise llfuse.FUSEError(errno.EINVAL)
 
-        if offset != grid_in_size(grid_in):
-            raise llfuse.FUSEError(errno.EINVAL)
+            try:
+                writer.write(data)
+            except UploadFailed:
+                self.logger.exception("write failed: %s %s", fd, offset)
+                raise llfuse.FUSEError(errno.EIO)
 
-        grid_in.write(data)
+        if self.metrics is not None:
+            self.metrics.bytes_written.inc(len(data))
         return len(data)
 
+    @instrumented
+    @global_lock_released
     def release(self, fd):
-        self.logger.debug("release: %s", fd)
+        if self.debug:
+            self.logger.debug("release: %s", fd)
 
-        if fd in self.active_writes:
-            self.active_writes.pop(fd).close()
+        with self.fd_locks.pop(fd):
+            try:
+                if fd in self.active_writes:
+                    self._close_writer(self.active_writes.pop(fd))
+            finally:
+                self.active_reads.pop(fd, None)
+                self.fd_factory.release(fd)
+
+    def _close_writer(self, writer):
+        # Blocks until every chunk and the 'fs.files' document is stored.
+        try:
+            writer.close()
+        except (UploadFailed, pymongo.errors.PyMongoError):
+            self.logger.exception("close of inode %s failed", writer.files_id)
+            raise llfuse.FUSEError(errno.EIO)
 
-        if fd in self.active_reads:
-            self.active_reads.pop(fd).close()
+        self._record_file_size(writer)
 
-        self.fd_factory.release(fd)
+    def _record_file_size(self, writer):
+        # Keep the final size within the inode document.
+        # => getattr is answered without a round trip to 'fs.files'
+        fields = {
+            'length': writer.length,
+            'chunk_size': writer.chunk_size,
+            'md5': writer.md5
+        }
+
+        if writer.inline_data is not None:
+            fields['inline'] = True
+            fields['data'] = Binary(writer.inline_data)
+            self.chunk_cache.put((writer.files_id, 0), writer.inline_data)
+
+            # Recorded on create, but inline content is never compressed
+            fields['compression'] = None
+
+        self.group_committer.submit(pymongo.UpdateOne(
+            {"_id": writer.files_id},
+            {"$set": fields}))
+        self.entry_cache.invalidate(writer.files_id)
 
     def releasedir(self, inode):
-        self.logger.debug("releasedir: %s", inode)
+        if self.debug:
+            self.logger.debug("releasedir: %s", inode)
 
     def forget(self, inode_list):
-        self.logger.debug("forget: %s", inode_list)
+        if self.debug:
+            self.logger.debug("forget: %s", inode_list)
 
     def readlink(self, inode, ctx):
-        self.logger.debug("readlink: %s", inode)
+        if self.debug:
+            self.logger.debug("readlink: %s", inode)
         raise llfuse.FUSEError(errno.ENOSYS)
 
     def symlink(self, folder_inode, name, target, ctx):
-        self.logger.debug("symlink: %s %s %s", folder_inode, name, target)
+        if self.debug:
+            self.logger.debug("symlink: %s %s %s", folder_inode, name, target)
         raise llfuse.FUSEError(errno.ENOSYS)
 
+    @instrumented
+    @global_lock_released
     def rename(self, old_folder_inode, old_name, new_folder_inode, new_name, ctx):
-        self.logger.debug(
-            "rename: %s %s %s %s",
-            old_folder_inode,
-            old_name,
-            new_folder_inode,
-            new_name)
+        if self.debug:
+            self.logger.debug(
+                "rename: %s %s %s %s",
+                old_folder_inode,
+                old_name,
+                new_folder_inode,
+                new_name)
 
         # Load the entry to move
-        entry_attributes = self.lookup(old_folder_inode, old_name)
-        entry = self._entry_by_inode(entry_attributes.st_ino)
+        entry = self._child_entry(old_folder_inode, old_name)
+        if entry is None:
+            raise llfuse.FUSEError(errno.ENOENT)
 
-        # Load the target directory
-        new_folder = self._entry_by_inode(new_folder_inode)
+        # An existing entry with the new name gets replaced.
+        target = self._child_entry(new_folder_inode, new_name)
+        if target is not None:
+            self._rename_check_target(entry, target)
 
-        # Check if the folder already contains this name and remove it.
-        if new_name in new_folder.childs:
-            noop = lambda entry: None
-            self._delete_inode(new_folder.inode, new_name, noop)
+            # Both names refer to the same inode => nothing to do
+            if target.inode == entry.inode:
+                return
+
+        # Removing the target and moving the entry is one ordered bulk write
+        # on the metadata collection => a single round trip.
+        requests = []
+        if target is not None:
+            requests.append(pymongo.DeleteOne({"_id": target.inode}))
 
         # Set the new parent and filename to the existing inode.
-        query = {"_id": entry.inode}
+        # This moves the entry from one folder into the other one.
         update = {
             "$set": {
-                'parent_inode': new_folder.inode,
+                'parent_inode': new_folder_inode,
                 'filename': new_name
             }
         }
-        self.meta.update_one(query, update)
+        requests.append(pymongo.UpdateOne({"_id": entry.inode}, update))
+
+        try:
+            self.meta.bulk_write(requests, ordered=True)
+        except pymongo.errors.BulkWriteError as e:
+            self.logger.error("rename failed: %s", e.details)
+
+            # The target might be gone although the move failed
+            if target is not None and e.details.get('nRemoved'):
+                self._drop_replaced_entry(target)
+
+            # Somebody else created the new name meanwhile
+            codes = [error.get('code') for error in e.details.get('writeErrors', [])]
+            if DUPLICATE_KEY in codes:
+                raise llfuse.FUSEError(errno.EEXIST)
+            raise llfuse.FUSEError(errno.EIO)
+        finally:
+            self.entry_cache.invalidate(entry.inode)
+            self.name_cache.invalidate((old_folder_inode, old_name))
+            self.name_cache.invalidate((new_folder_inode, new_name))
 
-        # Erase the inode from the older folder.
-        query = {"_id": old_folder_inode}
-        update = {"$pull": {'childs': (entry.filename, entry.inode)}}
-        self.meta.update_one(query, update)
+            if stat.S_ISDIR(entry.mode):
+                self.path_cache.clear()
 
-        # Add the inode to the new folder
-        query = {"_id": new_folder.inode}
-        update = {"$addToSet": {'childs': (new_name, entry.inode)}}
-        self.meta.update_one(query, update)
+        if target is not None:
+            self._drop_replaced_entry(target)
 
         # Ensure the correct filename within gridfs
-        entry.parent_inode = new_folder.inode
+        entry = copy.copy(entry)
+        entry.parent_inode = new_folder_inode
         entry.filename = new_name
-
         gridfs_filename = self._create_full_path(entry)
-        query = {"_id": entry.inode}
-        update = {"$set": {'filename': gridfs_filename}}
-        self.gridfs_files.update_one(query, update)
+
+        if stat.S_ISDIR(entry.mode):
+            # Do not block the rename on big trees
+            self.filename_rewriter.submit(entry.inode, gridfs_filename)
+        elif not entry.inline:
+            query = {"_id": entry.inode}
+            update = {"$set": {'filename': gridfs_filename}}
+            self.gridfs_files.update_one(query, update)
+
+    def _rename_check_target(self, entry, target):
+        # Like rename(2): a folder replaces only an empty folder,
+        # a file only a file.
+        if stat.S_ISDIR(target.mode):
+            if not stat.S_ISDIR(entry.mode):
+                raise llfuse.FUSEError(errno.EISDIR)
+
+            if target.inode != entry.inode and self._has_children(target.inode):
+                raise llfuse.FUSEError(errno.ENOTEMPTY)
+
+        elif stat.S_ISDIR(entry.mode):
+            raise llfuse.FUSEError(errno.ENOTDIR)
+
+    def _drop_replaced_entry(self, target):
+        self.entry_cache.invalidate(target.inode)
+        self.path_cache.invalidate(target.inode)
+        if not stat.S_ISDIR(target.mode) and not target.inline:
+            self._delete_file_data(target.inode)
+
+    @instrumented
+    @global_lock_released
+    def getxattr(self, inode, name, ctx):
+        if self.debug:
+            self.logger.debug("getxattr: %s %s", inode, name)
+
+        # The kernel asks for 'security.capability' before every write,
+        # answered without looking at the entry.
+        field = XATTR_FIELDS.get(name)
+        if field is None:
+            raise llfuse.FUSEError(llfuse.ENOATTR)
+
+        entry = self._entry_by_inode(inode)
+        if getattr(entry, field) is None:
+            raise llfuse.FUSEError(llfuse.ENOATTR)
+
+        return str(getattr(entry, field)).encode()
+
+    @instrumented
+    @global_lock_released
+    def listxattr(self, inode, ctx):
+        if self.debug:
+            self.logger.debug("listxattr: %s", inode)
+
+        entry = self._entry_by_inode(inode)
+        return [
+            name for name, field in XATTR_FIELDS.items()
+            if getattr(entry, field) is not None
+        ]
+
+    @instrumented
+    @global_lock_released
+    def setxattr(self, inode, name, value, ctx):
+        if self.debug:
+            self.logger.debug("setxattr: %s %s %s", inode, name, value)
+
+        entry = copy.copy(self._folder_for_xattr(inode, name))
+        field = XATTR_FIELDS[name]
+
+        setattr(entry, field, self._parse_xattr(name, value))
+        self._update_entry(entry, [field])
+
+    def _parse_xattr(self, name, value):
+        if name == XATTR_COMPRESSION:
+            # 'none' switches compression off below a compressed folder
+            codec = value.decode(errors='replace')
+            if codec not in compression.KNOWN_CODECS:
+                raise llfuse.FUSEError(errno.EINVAL)
+
+            try:
+                compression.check(codec)
+            except compression.CodecUnavailable:
+                raise llfuse.FUSEError(errno.ENOTSUP)
+            return codec
+
+        try:
+            chunk_size = int(value)
+        except ValueError:
+            raise llfuse.FUSEError(errno.EINVAL)
+
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise llfuse.FUSEError(errno.EINVAL)
+        return chunk_size
+
+    @instrumented
+    @global_lock_released
+    def removexattr(self, inode, name, ctx):
+        if self.debug:
+            self.logger.debug("removexattr: %s %s", inode, name)
+
+        entry = copy.copy(self._folder_for_xattr(inode, name))
+        field = XATTR_FIELDS[name]
+        if getattr(entry, field) is None:
+            raise llfuse.FUSEError(llfuse.ENOATTR)
+
+        setattr(entry, field, None)
+        self._update_entry(entry, [field])
+
+    def _folder_for_xattr(self, inode, name):
+        # Only folder settings can be changed.
+        # Files keep the chunk size/compression they got written with.
+        if name not in XATTR_FIELDS:
+            raise llfuse.FUSEError(errno.ENOTSUP)
+
+        entry = self._entry_by_inode(inode)
+        if not stat.S_ISDIR(entry.mode):
+            raise llfuse.FUSEError(errno.ENOTSUP)
+
+        return entry
 
     def link(self, inode, new_parent_inode, new_name, ctx):
-        self.logger.debug("link: %s %s %s", inode, new_parent_inode, new_name)
+        if self.debug:
+            self.logger.debug("link: %s %s %s", inode, new_parent_inode, new_name)
         raise llfuse.FUSEError(errno.ENOSYS)
 
     def flush(self, fd):
-        self.logger.debug("flush: %s", fd)
+        if self.debug:
+            self.logger.debug("flush: %s", fd)
         raise llfuse.FUSEError(errno.ENOSYS)
 
     def fsync(self, fd, datasync):
-        self.logger.debug("fsync: %s %s", fd, datasync)
+        if self.debug:
+            self.logger.debug("fsync: %s %s", fd, datasync)
         raise llfuse.FUSEError(errno.ENOSYS)
 
     def fsyncdir(self, fd, datasync):
-        self.logger.debug("fsyncdir: %s %s", fd, datasync)
+        if self.debug:
+            self.logger.debug("fsyncdir: %s %s", fd, datasync)
         raise llfuse.FUSEError(errno.ENOSYS)
 
+    @instrumented
     def statfs(self, ctx):
-        self.logger.debug("statfs")
-        raise llfuse.FUSEError(errno.ENOSYS)
+        if self.debug:
+            self.logger.debug("statfs")
+        return self.fs_stats.statvfs()
 
     def _entry_by_inode(self, inode):
+        entry = self.entry_cache.get(inode)
+        if entry is not None:
+            return entry
+
+        token = self.entry_cache.token()
+
         query = {'_id': inode}
 
-        record = self.meta.find_one(query)
+        record = self.meta.find_one(query, ENTRY_PROJECTION)
         if record is None:
             raise EntryNotFound.make(inode)
 
-        return self._doc_to_entry(record)
+        entry = self._doc_to_entry(record)
+        self.entry_cache.put(inode, entry, token)
+        return entry
+
+    def _parent_inode(self, inode):
+        entry = self.entry_cache.get(inode)
+        if entry is not None:
+            return entry.parent_inode
+
+        record = self.meta.find_one({'_id': inode}, {'parent_inode': True})
+        if record is None:
+            raise EntryNotFound.make(inode)
+        return record['parent_inode']
+
+    def _has_children(self, folder_inode):
+        # The root is its own parent
+        query = {'parent_inode': folder_inode, '_id': {'$ne': folder_inode}}
+        return self.meta.find_one(query, ID_PROJECTION) is not None
+
+    def _child_entry(self, folder_inode, name, with_data=False):
+        key = (folder_inode, name)
+
+        inode = self.name_cache.get(key)
+        if inode == 0:
+            return None
+
+        if inode is not None:
+            # The entry cache is kept coherent, the name cache is not.
+            # => A renamed/deleted inode does not match anymore.
+            entry = self.entry_cache.get(inode)
+            if (entry is not None and
+                    entry.parent_inode == folder_inode and
+                    entry.filename == name):
+                return entry
+
+        token = self.entry_cache.token()
+        name_token = self.name_cache.token()
+
+        # Served by the unique (parent_inode, filename) index
+        query = {'parent_inode': folder_inode, 'filename': name}
+        # Inline content only for lookups, unlink/rmdir/rename never read it
+        projection = INLINE_ENTRY_PROJECTION if with_data else ENTRY_PROJECTION
+        record = self.meta.find_one(query, projection)
+        if record is None:
+            self.name_cache.put(key, 0, name_token, self.negative_lookup_ttl)
+            return None
+
+        entry = self._doc_to_entry(record)
+        if with_data and entry.inline:
+            self.chunk_cache.put((entry.inode, 0), bytes(record['data']))
+
+        self.entry_cache.put(entry.inode, entry, token)
+        self.name_cache.put(key, entry.inode, name_token)
+        return entry
 
     def _insert_entry(self, entry):
         doc = self._entry_to_doc(entry)
-        self.meta.insert_one(doc)
+        self.group_committer.submit(pymongo.InsertOne(doc))
 
-    def _update_entry(self, entry):
+    def _update_entry(self, entry, fields):
         query = {"_id": entry.inode}
-        doc = self._entry_to_doc(entry)
+        doc = {field: getattr(entry, field) for field in fields}
         self.meta.update_one(query, {"$set": doc})
+        self.entry_cache.invalidate(entry.inode)
 
     def _entry_to_doc(self, entry):
-        doc = dict(vars(entry))
-        del doc['_ops']
-        doc['childs'] = list(entry.childs.items())
-        return doc
+        return {field: getattr(entry, field) for field in Entry.__slots__}
 
     def _doc_to_entry(self, doc):
-        doc['_ops'] = self
-        doc['childs'] = dict(doc['childs'])
+        # Missing fields (length, chunk_size, md5 of directories and files
+        # which are still written) are None, unknown ones are ignored.
         entry = object.__new__(Entry)
-        entry.__dict__.update(doc)
+        for field in Entry.__slots__:
+            setattr(entry, field, doc.get(field))
         return entry
 
-    def _gen_attr(self, entry):
+    def _gen_attr(self, entry, size=None):
         attr = llfuse.EntryAttributes()
 
         attr.st_ino = entry.inode
         attr.generation = 0
-        attr.entry_timeout = 10
-        attr.attr_timeout = 10
+        attr.entry_timeout = self.entry_timeout
+
+        # Size and times of a file change until it is closed
+        if stat.S_ISDIR(entry.mode) or entry.length is not None:
+            attr.attr_timeout = self.attr_timeout
+        else:
+            attr.attr_timeout = 0
 
         attr.st_mode = entry.mode
         attr.st_nlink = 1
@@ -488,7 +1373,9 @@ class Operations(llfuse.Operations):
         attr.st_gid = entry.gid
         attr.st_rdev = 0
 
-        attr.st_size = self._get_entry_size(entry)
+        if size is None:
+            size = self._get_entry_size(entry)
+        attr.st_size = size
 
         attr.st_blksize = 512
         attr.st_blocks = (attr.st_size // attr.st_blksize) + 1
@@ -503,9 +1390,15 @@ class Operations(llfuse.Operations):
         if stat.S_ISDIR(entry.mode):
             return 4096
 
-        if entry.inode in self.active_writes:
-            return grid_in_size(self.active_writes[entry.inode])
+        if entry.length is not None:
+            return entry.length
 
+        size = self._active_write_size(entry.inode)
+        if size is not None:
+            return size
+
+        # Only files still being written (or written by an older version)
+        # lack the length within their inode.
         # pymongo creates the entry only when the file is completely written
         # and *closed* by the writer.
         # => As long as the file is written (not closed) 'self.gridfs.get'
@@ -519,17 +1412,19 @@ class Operations(llfuse.Operations):
         except gridfs.errors.NoFile:
             return 0
 
+    def _active_write_size(self, inode):
+        for writer in list(self.active_writes.values()):
+            if writer.files_id == inode:
+                return writer.length
+        return None
+
     def _gen_inode(self):
-        query = {"_id": "next_inode"}
-        update = {"$inc": {"value": 1}}
-        doc = self.meta.find_one_and_update(query, update)
-        return doc['value']
+        return self.inode_allocator.gen()
 
 
 def _ensure_root_inode(ops):
     root = Entry(
-        ops,
-        '/',
+        b'/',
         llfuse.ROOT_INODE,
         llfuse.ROOT_INODE,
         stat.S_IFDIR | stat.S_IRWXU | mask,
@@ -562,6 +1457,26 @@ def _ensure_indexes(ops):
     ]
     ops.meta.create_index(index, unique=True)
 
+    # readdir lists the childs of a folder in inode order
+    index = [
+        ('parent_inode', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING)
+    ]
+    ops.meta.create_index(index)
+
+    # Chunks are written without GridIn, which used to create these.
+    index = [
+        ('files_id', pymongo.ASCENDING),
+        ('n', pymongo.ASCENDING)
+    ]
+    ops.gridfs_chunks.create_index(index, unique=True)
+
+    index = [
+        ('filename', pymongo.ASCENDING),
+        ('uploadDate', pymongo.ASCENDING)
+    ]
+    ops.gridfs_files.create_index(index)
+
 
 def get_compat_version(client):
     compat_cmd = {"getParameter": 1, "featureCompatibilityVersion": 1}
@@ -574,9 +1489,44 @@ def get_compat_version(client):
 
 
 def operations_factory(options):
-    client = create_mongo_client(options.mongodb_uri)
-
-    ops = Operations(client[options.database])
+    # Metrics and traces are only recorded if there is an endpoint
+    # serving them (see main.start_metrics_server).
+    metrics = None
+    tracer = None
+    listeners = None
+    if options.metrics_port is not None or options.metrics_socket is not None:
+        metrics = Metrics()
+        listeners = [metrics.command_listener()]
+
+        if options.trace_sample_rate > 0:
+            tracer = Tracer(options.trace_sample_rate, options.trace_buffer_size)
+
+    client = create_mongo_client(options.mongodb_uri, listeners)
+
+    ops = Operations(
+        client[options.database],
+        metadata_cache_size=options.metadata_cache_size,
+        metadata_cache_ttl=options.metadata_cache_ttl,
+        negative_lookup_ttl=options.negative_lookup_ttl,
+        workers=options.workers,
+        chunk_cache_size=options.chunk_cache_size,
+        read_ahead=options.read_ahead,
+        write_buffer_size=options.write_buffer_size,
+        chunk_size=options.chunk_size,
+        inline_threshold=options.inline_threshold,
+        dedup=options.dedup,
+        compression=options.compression,
+        entry_timeout=options.entry_timeout,
+        attr_timeout=options.attr_timeout,
+        negative_timeout=options.negative_timeout,
+        inode_block_size=options.inode_block_size,
+        group_commit_window=options.group_commit_window,
+        reaper_batch_size=options.reaper_batch_size,
+        reaper_rate=options.reaper_rate,
+        quota=options.quota,
+        statfs_interval=options.statfs_interval,
+        metrics=metrics,
+        tracer=tracer)
     _ensure_root_inode(ops)
     _ensure_next_inode_document(ops)
     _ensure_indexes(ops)
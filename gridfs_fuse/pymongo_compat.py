@@ -9,8 +9,8 @@ class CompatCollection(object):
     def __init__(self, database, collection_name):
         self.coll = database[collection_name]
 
-    def create_index(self, index, unique):
-        return self.coll.create_index(index, unique=True)
+    def create_index(self, index, unique=False):
+        return self.coll.create_index(index, unique=unique)
 
     def update_one(self, query, update):
         return self.coll.update(query, update, multi=False)
@@ -21,6 +21,9 @@ class CompatCollection(object):
     def find_one(self, query):
         return self.coll.find_one(query)
 
+    def find(self, query, projection=None):
+        return self.coll.find(query, projection)
+
     def insert_one(self, doc):
         return self.coll.insert(doc)
 
@@ -0,0 +1,232 @@
+"""Chunk wise reading of gridfs files with read-ahead.
+
+All readers share one ChunkCache, so repeated and concurrent reads of the
+same file are served from memory. A reader detecting sequential access
+prefetches the following chunks in the background.
+Compressed chunks are decompressed in a thread pool, the cache holds
+the decompressed data.
+"""
+import logging
+import functools
+import threading
+import concurrent.futures
+
+from . import compression
+
+
+class MissingChunk(Exception):
+    @classmethod
+    def make(cls, files_id, n):
+        return cls("Chunk %s of gridfs file %s is missing" % (n, files_id))
+
+
+class ChunkFetcher(object):
+    """Fetches chunks from 'fs.chunks' through the shared chunk cache.
+
+    Prefetches run in a thread pool. A chunk which is currently prefetched
+    is not fetched a second time, readers wait for the prefetch instead.
+    """
+
+    def __init__(self, chunks_collection, chunk_cache, workers, block_store):
+        self.logger = logging.getLogger("gridfs_fuse")
+
+        self.chunks = chunks_collection
+        self.cache = chunk_cache
+        self.block_store = block_store
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="gridfs_fuse-read-ahead")
+
+        # Chunks of one fetch are decompressed in parallel
+        self.decompressor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="gridfs_fuse-decompress")
+
+        # (files_id, n): Future of a running prefetch
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.decompressor.shutdown(wait=False)
+
+    def get(self, files_id, first, last, codec=None):
+        """Return the data of the chunks 'first'...'last' (inclusive)."""
+        chunks = {}
+        for n in range(first, last + 1):
+            data = self.cache.get((files_id, n))
+            if data is not None:
+                chunks[n] = data
+
+        waiting = []
+        to_fetch = []
+        with self._lock:
+            for n in range(first, last + 1):
+                if n in chunks:
+                    continue
+
+                future = self._inflight.get((files_id, n))
+                if future is None:
+                    to_fetch.append(n)
+                else:
+                    waiting.append((n, future))
+
+        if to_fetch:
+            chunks.update(self._fetch(files_id, to_fetch[0], to_fetch[-1], codec))
+
+        for n, future in waiting:
+            try:
+                chunks.update(future.result())
+            except Exception:
+                # Error got already logged by the prefetch
+                pass
+
+            if n not in chunks:
+                chunks.update(self._fetch(files_id, n, n, codec))
+
+        for n in range(first, last + 1):
+            if n not in chunks:
+                raise MissingChunk.make(files_id, n)
+
+        return [chunks[n] for n in range(first, last + 1)]
+
+    def prefetch(self, files_id, first, last, codec=None):
+        """Load the chunks 'first'...'last' into the cache in the background."""
+        with self._lock:
+            wanted = [
+                n for n in range(first, last + 1)
+                if (files_id, n) not in self.cache and
+                (files_id, n) not in self._inflight
+            ]
+
+            if not wanted:
+                return
+
+            future = self.executor.submit(
+                self._prefetch, files_id, wanted[0], wanted[-1], codec)
+
+            for n in wanted:
+                self._inflight[(files_id, n)] = future
+
+    def _prefetch(self, files_id, first, last, codec):
+        try:
+            return self._fetch(files_id, first, last, codec)
+        except Exception:
+            self.logger.exception(
+                "Read-ahead of chunks %s-%s of %s failed", first, last, files_id)
+            raise
+        finally:
+            with self._lock:
+                for n in range(first, last + 1):
+                    self._inflight.pop((files_id, n), None)
+
+    def _fetch(self, files_id, first, last, codec):
+        # One round trip, served by the unique (files_id, n) index
+        query = {'files_id': files_id, 'n': {'$gte': first, '$lt': last + 1}}
+        projection = {'_id': False, 'n': True, 'data': True, 'hash': True}
+
+        chunks = {}
+        deduplicated = {}
+        for doc in self.chunks.find(query, projection):
+            if 'hash' in doc:
+                deduplicated[doc['n']] = doc['hash']
+            else:
+                chunks[doc['n']] = bytes(doc['data'])
+
+        # Data of deduplicated chunks, one more round trip
+        if deduplicated:
+            blocks = self.block_store.fetch(deduplicated.values())
+            for n, hash_ in deduplicated.items():
+                if hash_ in blocks:
+                    chunks[n] = blocks[hash_]
+
+        if codec is not None:
+            numbers = list(chunks)
+            datas = self.decompressor.map(
+                functools.partial(compression.decompress, codec),
+                [chunks[n] for n in numbers])
+            chunks = dict(zip(numbers, datas))
+
+        for n, data in chunks.items():
+            self.cache.put((files_id, n), data)
+
+        return chunks
+
+
+class InlineReader(object):
+    """Reads a file kept within its inode document, no chunks involved."""
+
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+
+    def read(self, offset, length):
+        return self.data[offset:offset + length]
+
+
+class ChunkReader(object):
+    """Reads one gridfs file, a new instance per file descriptor.
+
+    'read' is positional (pread) and safe to call concurrently: the chunks
+    covering the range come from the cache or from one query. The only
+    state is the sequential access detection for read-ahead, a race there
+    just starts or skips a prefetch.
+    """
+
+    def __init__(self, fetcher, files_id, length, chunk_size, read_ahead,
+                 codec=None):
+        self.fetcher = fetcher
+        self.files_id = files_id
+        self.length = length
+        self.chunk_size = chunk_size
+        self.codec = codec
+
+        # Number of chunks to prefetch on sequential access
+        self.read_ahead = read_ahead
+
+        # A sequential reader continues here
+        self._next_offset = 0
+
+        # Last chunk which got prefetched
+        self._prefetched_until = -1
+
+    def read(self, offset, length):
+        end = min(offset + length, self.length)
+        if offset >= end:
+            return b''
+
+        first = offset // self.chunk_size
+        last = (end - 1) // self.chunk_size
+
+        sequential = offset == self._next_offset
+        self._next_offset = end
+
+        chunks = self.fetcher.get(self.files_id, first, last, self.codec)
+
+        if sequential and self.read_ahead > 0:
+            self._read_ahead(last)
+
+        start = offset - first * self.chunk_size
+        if len(chunks) == 1:
+            return chunks[0][start:start + end - offset]
+
+        # Copied once into a buffer of the final size (join sizes it
+        # upfront), no intermediate concatenation of whole chunks.
+        views = [memoryview(chunk) for chunk in chunks]
+        views[0] = views[0][start:]
+        views[-1] = views[-1][:end - last * self.chunk_size]
+        return b''.join(views)
+
+    def _read_ahead(self, last):
+        # Refill the window once half of it got consumed.
+        # => Prefetches are done in batches, not chunk by chunk.
+        if self._prefetched_until - last >= max(1, self.read_ahead // 2):
+            return
+
+        last_chunk = (self.length - 1) // self.chunk_size
+        first = max(last, self._prefetched_until) + 1
+        until = min(first + self.read_ahead - 1, last_chunk)
+
+        if first <= until:
+            self.fetcher.prefetch(self.files_id, first, until, self.codec)
+            self._prefetched_until = until
@@ -0,0 +1,137 @@
+"""Background deletion of the chunks of unlinked files.
+
+Deleting a big file means deleting hundreds of thousands of chunk
+documents. unlink only queues the file, the reaper deletes its chunks
+in bounded batches with a rate limit. The queue is a mongodb collection,
+so pending deletions survive restarts and are picked up by any mount.
+A mount leases a queued file before it reaps it, so no two mounts work
+on the same file. Deduplicated chunks release their block (see dedup.py).
+"""
+import time
+import uuid
+import logging
+import threading
+
+import pymongo
+
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCHES_PER_SECOND = 10
+
+# Seconds a mount owns a queued file, renewed with every batch.
+# Expires if the mount dies, another one takes over then.
+LEASE_DURATION = 60
+
+
+class ChunkReaper(object):
+    def __init__(self, queue_collection, chunks_collection, block_store,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 batches_per_second=DEFAULT_BATCHES_PER_SECOND):
+        self.logger = logging.getLogger("gridfs_fuse")
+
+        self.queue = queue_collection
+        self.chunks = chunks_collection
+        self.block_store = block_store
+        self.batch_size = batch_size
+        self.batches_per_second = batches_per_second
+
+        # Owner of leases taken by this reaper
+        self.owner = uuid.uuid4().hex
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name="gridfs_fuse-reaper",
+            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def pending(self):
+        return self.queue.estimated_document_count()
+
+    def enqueue(self, files_id):
+        try:
+            self.queue.insert_one({'_id': files_id, 'queued_ns': time.time_ns()})
+        except pymongo.errors.DuplicateKeyError:
+            pass
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                # Cleared before looking => a file queued meanwhile
+                # sets it again and the wait returns at once.
+                self._wakeup.clear()
+                doc = self._claim()
+                if doc is None:
+                    self._wakeup.wait(60)
+                    continue
+
+                self._reap(doc['_id'])
+            except pymongo.errors.PyMongoError:
+                self.logger.exception("Reaper failed, retrying")
+                self._stopped.wait(5)
+
+    def _claim(self):
+        now = time.time()
+        query = {
+            '$or': [
+                {'lease_until': {'$exists': False}},
+                {'lease_until': {'$lt': now}}
+            ]
+        }
+        update = {
+            '$set': {'owner': self.owner, 'lease_until': now + LEASE_DURATION}
+        }
+
+        return self.queue.find_one_and_update(
+            query,
+            update,
+            projection={'_id': True},
+            sort=[('_id', pymongo.ASCENDING)])
+
+    def _renew(self, files_id):
+        query = {'_id': files_id, 'owner': self.owner}
+        update = {'$set': {'lease_until': time.time() + LEASE_DURATION}}
+        return self.queue.update_one(query, update).matched_count > 0
+
+    def _reap(self, files_id):
+        # No 'limit' for delete_many => find a batch of ids first.
+        # Served by the unique (files_id, n) index.
+        query = {'files_id': files_id}
+        projection = {'_id': True, 'hash': True}
+
+        while not self._stopped.is_set():
+            # Lease expired and taken over by another mount
+            if not self._renew(files_id):
+                return
+
+            docs = list(self.chunks.find(query, projection).limit(self.batch_size))
+            if not docs:
+                self.queue.delete_one({'_id': files_id, 'owner': self.owner})
+                return
+
+            result = self.chunks.delete_many(
+                {'_id': {'$in': [doc['_id'] for doc in docs]}})
+
+            # Only after the chunks are gone, a crash in between leaks
+            # references but never drops a block still in use.
+            # Released only if all of them got deleted by this reaper,
+            # otherwise somebody else (late lease owner) releases them.
+            hashes = [doc['hash'] for doc in docs if 'hash' in doc]
+            if hashes and result.deleted_count == len(docs):
+                self.block_store.release(hashes)
+            elif hashes:
+                self.logger.warning(
+                    "Chunks of %s got deleted concurrently, "
+                    "their blocks keep a reference", files_id)
+
+            if self.batches_per_second > 0:
+                self._stopped.wait(1.0 / self.batches_per_second)
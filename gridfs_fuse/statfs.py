@@ -0,0 +1,113 @@
+"""Numbers for statfs, refreshed in the background.
+
+dbStats/collStats can be expensive on big databases, so 'df' must never
+trigger them. A thread refreshes them every 'interval' seconds and
+statfs answers from the last result.
+"""
+import logging
+import threading
+
+import llfuse
+import pymongo
+
+
+BLOCK_SIZE = 4096
+NAME_MAX = 255
+
+# Inodes are not limited, report plenty of free ones
+FREE_INODES = 2 ** 32
+
+DEFAULT_INTERVAL = 60
+
+
+class FilesystemStats(object):
+    def __init__(self, database, quota=None, interval=DEFAULT_INTERVAL):
+        self.logger = logging.getLogger("gridfs_fuse")
+
+        self.database = database
+        self.quota = quota
+        self.interval = interval
+
+        # Bytes, last refresh
+        self.total = 0
+        self.used = 0
+        self.free = 0
+        self.inodes = 0
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name="gridfs_fuse-statfs",
+            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except pymongo.errors.PyMongoError:
+                self.logger.exception("Refresh of filesystem statistics failed")
+            self._stopped.wait(self.interval)
+
+    def refresh(self):
+        chunks = self._coll_stats('fs.chunks')
+        metadata = self._coll_stats('metadata')
+
+        # Exists only once a mount deduplicated chunks
+        try:
+            blocks = self._coll_stats('blocks')
+        except pymongo.errors.OperationFailure:
+            blocks = {}
+
+        used = sum(
+            stats.get('size', 0)
+            for stats in (chunks, metadata, blocks))
+
+        if self.quota:
+            total = self.quota
+            free = max(0, self.quota - used)
+        else:
+            # Space of the filesystem holding the database (mongodb >= 3.6)
+            db_stats = self.database.command('dbStats')
+            total = db_stats.get('fsTotalSize', used)
+            free = max(0, total - db_stats.get('fsUsedSize', total))
+
+        self.total = total
+        self.used = used
+        self.free = free
+        self.inodes = metadata.get('count', 0)
+
+    def _coll_stats(self, name):
+        try:
+            return self.database.command('collStats', name)
+        except pymongo.errors.OperationFailure:
+            # 'collStats' got removed in favour of the $collStats stage
+            pipeline = [{'$collStats': {'storageStats': {}}}]
+            for doc in self.database[name].aggregate(pipeline):
+                return doc['storageStats']
+            return {}
+
+    def statvfs(self):
+        stat_ = llfuse.StatvfsData()
+
+        stat_.f_bsize = BLOCK_SIZE
+        stat_.f_frsize = BLOCK_SIZE
+
+        stat_.f_blocks = self.total // BLOCK_SIZE
+        stat_.f_bfree = self.free // BLOCK_SIZE
+        stat_.f_bavail = stat_.f_bfree
+
+        stat_.f_files = self.inodes + FREE_INODES
+        stat_.f_ffree = FREE_INODES
+        stat_.f_favail = FREE_INODES
+
+        stat_.f_namemax = NAME_MAX
+
+        return stat_
+
@@ -0,0 +1,33 @@
+"""Sampled structured tracing of request handlers.
+
+A sampled call is recorded as (time, op, inode/fd, latency, bytes) in a
+ring buffer. Recording is a deque append, so tracing a small fraction
+of the requests has no noticeable cost. The buffer is dumped on demand
+as JSON lines (see MetricsServer '/trace').
+"""
+import json
+import time
+import random
+import collections
+
+
+DEFAULT_BUFFER_SIZE = 10000
+
+FIELDS = ('time', 'op', 'target', 'latency', 'bytes')
+
+
+class Tracer(object):
+    def __init__(self, sample_rate, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sample_rate = sample_rate
+        self.buffer = collections.deque(maxlen=buffer_size)
+
+    def sample(self):
+        return random.random() < self.sample_rate
+
+    def record(self, op, target, latency, nbytes):
+        self.buffer.append((time.time(), op, target, latency, nbytes))
+
+    def dump(self):
+        return ''.join(
+            json.dumps(dict(zip(FIELDS, record))) + '\n'
+            for record in list(self.buffer))
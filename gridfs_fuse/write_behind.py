@@ -0,0 +1,294 @@
+"""Write-behind uploads of gridfs chunks.
+
+Written data is cut into chunks which are inserted into 'fs.chunks' by
+background threads with 'insert_many'. The amount of chunk data waiting
+for its upload is bounded by a memory budget, writers block if it is
+exhausted. Like GridIn the 'fs.files' document is inserted last,
+so a file becomes visible for gridfs only once it is complete.
+"""
+import queue
+import hashlib
+import logging
+import datetime
+import threading
+
+import pymongo
+from bson import Binary
+
+from . import compression
+
+
+# Max. number of chunks per insert_many
+MAX_BATCH = 64
+
+
+class UploadFailed(Exception):
+    pass
+
+
+class MemoryBudget(object):
+    """Number of bytes which may wait for their upload."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        with self._cond:
+            # A single chunk bigger than the budget must still pass.
+            while self.used and self.used + size > self.max_bytes:
+                self._cond.wait()
+            self.used += size
+
+    def release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+class ChunkUploader(object):
+    """Background threads batching chunk inserts of all open files.
+
+    Chunks of compressed files are compressed within these threads.
+    With a 'block_store' the chunk data is deduplicated (see dedup.py),
+    hashing happens within these threads as well.
+    """
+
+    def __init__(self, chunks_collection, files_collection, max_bytes, workers,
+                 block_store=None):
+        self.logger = logging.getLogger("gridfs_fuse")
+
+        self.chunks = chunks_collection
+        self.files = files_collection
+        self.block_store = block_store
+        self.budget = MemoryBudget(max_bytes)
+
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                name="gridfs_fuse-upload-%s" % i,
+                daemon=True)
+            for i in range(workers)
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def discard(self, files_id):
+        """Delete the chunks of a file which could not be stored completely."""
+        if self.block_store is None:
+            self.chunks.delete_many({'files_id': files_id})
+            return
+
+        query = {'files_id': files_id}
+        docs = list(self.chunks.find(query, {'hash': True}))
+        self.chunks.delete_many(query)
+
+        hashes = [doc['hash'] for doc in docs if 'hash' in doc]
+        if hashes:
+            self.block_store.release(hashes)
+
+    def submit(self, writer, doc):
+        self.budget.acquire(len(doc['data']))
+        self._queue.put((writer, doc))
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        while len(batch) < MAX_BATCH:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is None:
+                # Keep the shutdown marker for the next round
+                self._queue.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _release_failed(self, docs, error):
+        """Drop the block references of chunks which were not inserted.
+
+        'discard' only sees the chunks within 'fs.chunks', references
+        taken for the others would keep their blocks forever.
+        """
+        # The block store failed => no chunk got as far as the insert
+        if not any('hash' in doc for doc in docs):
+            return
+
+        try:
+            if isinstance(error, pymongo.errors.BulkWriteError):
+                failed = [
+                    docs[write_error['index']]
+                    for write_error in error.details.get('writeErrors', [])
+                ]
+            else:
+                # Unknown how far the insert got
+                ids = [doc['_id'] for doc in docs if '_id' in doc]
+                query = {'_id': {'$in': ids}}
+                inserted = set(doc['_id'] for doc in self.chunks.find(query, {'_id': True}))
+                failed = [doc for doc in docs if doc.get('_id') not in inserted]
+
+            hashes = [doc['hash'] for doc in failed if 'hash' in doc]
+            if hashes:
+                self.block_store.release(hashes)
+        except Exception:
+            self.logger.exception("Release of %s blocks failed", len(docs))
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            docs = [doc for _, doc in batch]
+            size = sum(len(doc['data']) for doc in docs)
+
+            error = None
+            try:
+                for writer, doc in batch:
+                    if writer.compression is not None:
+                        doc['data'] = Binary(
+                            compression.compress(writer.compression, doc['data']))
+
+                if self.block_store is not None:
+                    self.block_store.store(docs)
+                self.chunks.insert_many(docs, ordered=False)
+            except Exception as e:
+                # Not only mongodb errors (codecs, too large documents, ...).
+                # The thread must survive, writers wait for these chunks.
+                self.logger.exception("Upload of %s chunks failed", len(batch))
+                error = e
+                if self.block_store is not None:
+                    self._release_failed(docs, e)
+            finally:
+                self.budget.release(size)
+                for writer, _ in batch:
+                    writer._chunk_done(error)
+
+
+class ChunkWriter(object):
+    """Writes one gridfs file, a new instance per file descriptor.
+
+    A file of at most 'inline_threshold' bytes is not stored within gridfs
+    at all. 'inline_data' holds its content after close, the caller keeps
+    it within the inode document.
+    Chunks are compressed with the codec 'compression' (None => not at all).
+    """
+
+    def __init__(self, uploader, files_id, filename, chunk_size,
+                 inline_threshold=0, compression=None):
+        self.uploader = uploader
+        self.files_id = files_id
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.inline_threshold = inline_threshold
+        self.inline_data = None
+
+        # Like GridIn, kept in 'fs.files' and the inode.
+        # Hex digest once closed.
+        self.md5 = None
+        self._md5 = hashlib.md5()
+
+        self.length = 0
+        self._buffer = bytearray()
+        self._next_n = 0
+
+        # Chunks handed to the uploader, but not inserted yet
+        self._pending = 0
+        self._error = None
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        self._check_error()
+
+        self._buffer += data
+        self.length += len(data)
+        self._md5.update(data)
+
+        # Might still become an inline file
+        if self.length <= self.inline_threshold:
+            return
+
+        while len(self._buffer) >= self.chunk_size:
+            self._emit(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+
+    def close(self):
+        """Returns once all chunks and the files document are stored."""
+        self.md5 = self._md5.hexdigest()
+
+        if self.inline_threshold and self.length <= self.inline_threshold:
+            self.inline_data = bytes(self._buffer)
+            self._buffer = bytearray()
+            return
+
+        if self._buffer:
+            self._emit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+
+        doc = {
+            '_id': self.files_id,
+            'filename': self.filename,
+            'length': self.length,
+            'chunkSize': self.chunk_size,
+            'md5': self.md5,
+            'uploadDate': datetime.datetime.now(datetime.timezone.utc),
+        }
+
+        # Tell other gridfs tools why the chunks look garbled
+        if self.compression is not None:
+            doc['metadata'] = {'compression': self.compression}
+
+        try:
+            self._check_error()
+            self.uploader.files.insert_one(doc)
+        except (UploadFailed, pymongo.errors.PyMongoError):
+            # Do not leave orphaned chunks behind
+            self.uploader.discard(self.files_id)
+            raise
+
+    def _emit(self, data):
+        doc = {
+            'files_id': self.files_id,
+            'n': self._next_n,
+            'data': Binary(data)
+        }
+        self._next_n += 1
+
+        with self._cond:
+            self._pending += 1
+        self.uploader.submit(self, doc)
+
+    def _chunk_done(self, error):
+        with self._cond:
+            self._pending -= 1
+            if error is not None and self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise UploadFailed(
+                "Upload of gridfs file %s failed: %s" %
+                (self.files_id, self._error))
@@ -3,17 +3,22 @@ from setuptools import find_packages
 
 setup(
     name="gridfs_fuse",
-    version="0.3.1",
+    version="0.5.0",
     install_requires=[
         'llfuse>=1.5.0',
         'pymongo',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+    },
     include_package_data=True,
     package_dir={'gridfs_fuse': 'gridfs_fuse'},
     packages=find_packages('.'),
     entry_points={
         'console_scripts': [
             'gridfs_fuse = gridfs_fuse.main:main',
+            'gridfs_fuse_dedup_report = gridfs_fuse.dedup_report:main',
         ]
     }
 )